@@ -0,0 +1,701 @@
+"""
+Route trips over the road graph with the bus edges added to it
+
+The graph is the networkx graph of OSMParser.read_osm where every edge has
+a 'duration' (s) and the edges between consecutive bus stops of a route also
+have the 'bus_id' of their bus, see CalculateBusTrips.py.
+
+The searches return the path together with the number of nodes they settled,
+so that their search spaces can be compared:
+
+- dijkstra : plain Dijkstra, stops when the target is settled
+- astar : A* with the straight line distance to the target at MAX_SPEED as
+  heuristic
+- bidirectional : Dijkstra from the source and the target at the same time
+
+All of them return a shortest path. Among paths of the same duration the
+searches may pick different ones.
+
+The bus edges are built from bus_routes.csv by bus_overlay, as arrays
+cached on disk, and added to the networkx graph with add_bus_edges. The
+TransitMatrix answers the same queries from the travel times between the bus
+stops, computed once over the arrays of the graph and cached on disk, and
+TransitRouter.py routes them over the stops with waiting for the buses.
+
+After a change of some bus routes only the trips returned by affected_trips
+need to be evaluated again, from the paths saved by save_trip_paths.
+"""
+import hashlib
+from heapq import heappush, heappop
+from itertools import count
+from math import asin, cos, radians, sin, sqrt
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.sparse import csgraph
+
+import OSMParser
+
+# Average Manhattan bus speed (m/s) of the bus edges
+BUS_SPEED = 2.5
+# Highest speed (m/s) on the graph. Every edge takes at least its straight
+# line length divided by it
+MAX_SPEED = BUS_SPEED
+# Radius of the earth (m) of OSMParser.haversine
+EARTH_RADIUS = 6371000
+# Average walking speed (m/s) of the walking edges
+WALKING_SPEED = 1.2
+
+
+def path_statistics(G, path):
+    """Return the duration, the number of buses taken, the number of unique
+    buses, the bus ride distance and the walking distance of the path.
+    """
+    total_duration = 0
+    walking_distance = 0
+    bus_ride_distance = 0
+    buses_used = 0
+    unique_buses = []
+    # Save previous method of transportation
+    walking_flag = True
+    for u, v in zip(path, path[1:]):
+        edge_data = G.get_edge_data(u, v)
+        total_duration += edge_data['duration']
+        if 'bus_id' in edge_data:
+            bus_ride_distance += edge_data['length']
+        else:
+            walking_distance += edge_data['length']
+        if 'bus_id' in edge_data and walking_flag:
+            buses_used += 1
+            walking_flag = False
+            bus_id = edge_data['bus_id']
+            if not(bus_id in unique_buses):
+                unique_buses.append(bus_id)
+        if not('bus_id' in edge_data) and not(walking_flag):
+            walking_flag = True
+    return (total_duration, buses_used, len(unique_buses), bus_ride_distance,
+            walking_distance)
+
+
+def _node_distance(G, u, v):
+    """ Straight line distance (m) between the nodes u and v."""
+    lon1, lat1 = radians(G.node[u]['lon']), radians(G.node[u]['lat'])
+    lon2, lat2 = radians(G.node[v]['lon']), radians(G.node[v]['lat'])
+    a = sin((lat2 - lat1) / 2) ** 2 + \
+        cos(lat1) * cos(lat2) * sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * asin(sqrt(a))
+
+
+def _trace(pred, node):
+    """ Return the path to node following the predecessors pred."""
+    path = [node]
+    while pred[path[-1]] is not None:
+        path.append(pred[path[-1]])
+    return path[::-1]
+
+
+def dijkstra_path(G, source, target, weight='duration'):
+    """Return the shortest path from source to target and the number of
+    settled nodes. Ties are broken like nx.dijkstra_path, so the paths are
+    the same.
+    """
+    c = count()
+    dist = {}
+    seen = {source: 0}
+    pred = {source: None}
+    heap = [(0, next(c), source)]
+    while heap:
+        d, _, u = heappop(heap)
+        if u in dist:
+            continue
+        dist[u] = d
+        if u == target:
+            break
+        for v, edge_data in G[u].items():
+            vu_dist = d + edge_data[weight]
+            if v not in dist and (v not in seen or vu_dist < seen[v]):
+                seen[v] = vu_dist
+                pred[v] = u
+                heappush(heap, (vu_dist, next(c), v))
+    return _trace(pred, target), len(dist)
+
+
+def astar_path(G, source, target, weight='duration'):
+    """Return the shortest path from source to target and the number of
+    settled nodes, using A* with the heuristic of MAX_SPEED.
+
+    The heuristic never overestimates because every edge length is at least
+    the straight line length between its nodes, and it is consistent so a
+    settled node is never settled again.
+    """
+    heuristic = {}
+
+    def h(u):
+        if u not in heuristic:
+            heuristic[u] = _node_distance(G, u, target) / MAX_SPEED
+        return heuristic[u]
+
+    c = count()
+    settled = set()
+    seen = {source: 0}
+    pred = {source: None}
+    heap = [(h(source), next(c), source, 0)]
+    while heap:
+        _, _, u, d = heappop(heap)
+        if u in settled:
+            continue
+        settled.add(u)
+        if u == target:
+            break
+        for v, edge_data in G[u].items():
+            vu_dist = d + edge_data[weight]
+            if v not in settled and (v not in seen or vu_dist < seen[v]):
+                seen[v] = vu_dist
+                pred[v] = u
+                heappush(heap, (vu_dist + h(v), next(c), v, vu_dist))
+    return _trace(pred, target), len(settled)
+
+
+def bidirectional_path(G, source, target, weight='duration'):
+    """Return the shortest path from source to target and the number of
+    settled nodes, searching from both ends of the undirected graph.
+
+    The search from the side with the smaller next distance goes on until
+    the two next distances add up to at least the best path found.
+    """
+    c = count()
+    # Distances, tentative distances, predecessors and heaps of the search
+    # from the source (0) and from the target (1)
+    dist = ({}, {})
+    seen = ({source: 0}, {target: 0})
+    pred = ({source: None}, {target: None})
+    heap = ([(0, next(c), source)], [(0, next(c), target)])
+    best = 0 if source == target else float('inf')
+    meeting_node = source
+    while heap[0] and heap[1]:
+        if heap[0][0][0] + heap[1][0][0] >= best:
+            break
+        side = 0 if heap[0][0][0] <= heap[1][0][0] else 1
+        d, _, u = heappop(heap[side])
+        if u in dist[side]:
+            continue
+        dist[side][u] = d
+        for v, edge_data in G[u].items():
+            vu_dist = d + edge_data[weight]
+            if v not in dist[side] and \
+                    (v not in seen[side] or vu_dist < seen[side][v]):
+                seen[side][v] = vu_dist
+                pred[side][v] = u
+                heappush(heap[side], (vu_dist, next(c), v))
+            # A path through the edge (u, v) between the two searches
+            if v in seen[1 - side] and vu_dist + seen[1 - side][v] < best:
+                best = vu_dist + seen[1 - side][v]
+                meeting_node = v
+    path = _trace(pred[0], meeting_node)
+    # The path from the target side is traced backwards
+    path.extend(_trace(pred[1], meeting_node)[-2::-1])
+    return path, len(dist[0]) + len(dist[1])
+
+
+# The searches by name, for the ROUTING option of the scripts
+ROUTINGS = {'dijkstra': dijkstra_path, 'astar': astar_path,
+            'bidirectional': bidirectional_path}
+
+
+def save_arrays(folder, names, arrays):
+    """ Save the arrays in folder as <name>.npy files."""
+    for name, array in zip(names, arrays):
+        np.save(os.path.join(str(folder), name + '.npy'), array)
+
+
+def load_arrays(folder, names, mmap_mode='r'):
+    """ Return the arrays saved in folder by save_arrays."""
+    return [np.load(os.path.join(str(folder), name + '.npy'),
+                    mmap_mode=mmap_mode) for name in names]
+
+
+def cache_arrays(cache_dir, key, names, arrays):
+    """Save the arrays in the folder key of cache_dir. They are written in a
+    temporary folder first like OSMParser.compile_osm, so that an interrupted
+    run never leaves half written arrays behind.
+    """
+    os.makedirs(str(cache_dir), exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=str(cache_dir))
+    save_arrays(tmp_dir, names, arrays)
+    try:
+        os.rename(tmp_dir, os.path.join(str(cache_dir), key))
+    except OSError:
+        # Another process saved the same arrays in the meantime
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def arrays_hash(*arrays):
+    """ Return the hex digest of the content of the arrays."""
+    h = hashlib.sha1()
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        h.update(str(array.dtype).encode())
+        h.update(array.tobytes())
+    return h.hexdigest()
+
+
+# Names of the arrays of the bus edges
+BUS_EDGE_ARRAYS = ('u', 'v', 'length', 'duration', 'bus_id')
+
+
+def build_bus_edges(graph, bus_routes_df, bus_stops_df):
+    """Return the edges between the consecutive stops of every bus route as
+    the arrays (u, v, length, duration, bus_id), u and v being the positions
+    of the stops in the RoadGraph.
+
+    Starting from the first node of a route, a stop of the bus is reached the
+    first time the route passes by it. Once all the stops are reached every
+    pass by the first node closes the loop again. The length of an edge is
+    the sum of the lengths of the route between its stops. The edges come in
+    route order, an edge between the same stops as an earlier one replaces
+    it.
+    """
+    edges = []
+    for bus_id, group in bus_routes_df.groupby('bus_id'):
+        route = graph.positions(group['route_nodes'].values)
+        stops = graph.positions(
+            bus_stops_df.loc[bus_stops_df['bus_id'] == bus_id, 'node_id'])
+        initial = route[0]
+        # Number of passes by every stop node that reach a stop, the route
+        # starts at the initial stop
+        stop_nodes, needed = np.unique(stops, return_counts=True)
+        needed[stop_nodes == initial] -= 1
+        nodes = route[1:]
+        # Count of the earlier passes by the node of every route position
+        order = np.argsort(nodes, kind='mergesort')
+        first = np.r_[0, np.flatnonzero(np.diff(nodes[order])) + 1]
+        passes = np.empty(len(nodes), dtype=np.int64)
+        passes[order] = np.arange(len(nodes)) - \
+            np.repeat(first, np.diff(np.r_[first, len(nodes)]))
+        idx = np.minimum(np.searchsorted(stop_nodes, nodes),
+                         len(stop_nodes) - 1)
+        reached = (stop_nodes[idx] == nodes) & (passes < needed[idx])
+        if needed.sum() > 0 and reached.sum() == needed.sum():
+            last = np.flatnonzero(reached)[-1]
+            reached |= (nodes == initial) & (np.arange(len(nodes)) > last)
+        # Positions of the stops in the route and the lengths between them
+        at_stop = np.r_[0, np.flatnonzero(reached) + 1]
+        edge_length = graph.edge_lengths(route[:-1], route[1:]).tolist()
+        # Summed in route order, a cumsum would round differently
+        length = np.array([sum(edge_length[a:b]) for a, b in
+                           zip(at_stop[:-1], at_stop[1:])], dtype=np.float64)
+        u = route[at_stop[:-1]]
+        v = route[at_stop[1:]]
+        # A loop on a stop changes no path
+        keep = u != v
+        edges.append((u[keep], v[keep], length[keep],
+                      length[keep] / BUS_SPEED,
+                      np.full(keep.sum(), bus_id, dtype=np.int64)))
+    if not edges:
+        return tuple(np.array([], dtype=dtype) for dtype in
+                     (np.int64, np.int64, np.float64, np.float64, np.int64))
+    return tuple(np.concatenate(arrays) for arrays in zip(*edges))
+
+
+def bus_overlay(graph, bus_routes_csv, bus_stops_csv, cache_dir):
+    """Return the bus edges of build_bus_edges. They are saved in cache_dir
+    under the hash of the graph and of the two csv files, so later calls with
+    the same inputs only load them.
+    """
+    with open(str(bus_routes_csv), 'rb') as f:
+        routes = np.frombuffer(f.read(), dtype=np.uint8)
+    with open(str(bus_stops_csv), 'rb') as f:
+        stops = np.frombuffer(f.read(), dtype=np.uint8)
+    key = arrays_hash(graph.node_ids, graph.indptr, graph.indices,
+                      graph.length, routes, stops)
+    edges_dir = os.path.join(str(cache_dir), key)
+    if os.path.isdir(edges_dir):
+        return tuple(load_arrays(edges_dir, BUS_EDGE_ARRAYS, mmap_mode=None))
+    edges = build_bus_edges(graph, pd.read_csv(str(bus_routes_csv)),
+                            pd.read_csv(str(bus_stops_csv)))
+    cache_arrays(cache_dir, key, BUS_EDGE_ARRAYS, edges)
+    return edges
+
+
+def add_bus_edges(G, graph, edges):
+    """ Add the bus edges to the networkx graph G of the RoadGraph."""
+    ids = graph.node_ids.astype(str).tolist()
+    for u, v, length, duration, bus_id in zip(*(a.tolist() for a in edges)):
+        G.add_edge(ids[u], ids[v], length=length, duration=duration,
+                   bus_id=bus_id)
+
+
+# Names of the arrays of network_arrays
+NETWORK_ARRAYS = ('indptr', 'indices', 'duration', 'length', 'bus_id')
+
+
+def network_arrays(graph, edges):
+    """Return the walking + bus graph as CSR arrays.
+
+    A bus edge replaces the walking edge between the same nodes, like the
+    edges of a networkx Graph. Returns indptr, indices and the duration,
+    length and bus_id (-1 for walking) of every edge, stored both ways.
+    """
+    n = len(graph)
+    bus_u, bus_v, bus_length, bus_duration, bus_id = edges
+    # Of the bus edges between the same nodes only the last one is kept
+    bus_keys = np.minimum(bus_u, bus_v) * n + np.maximum(bus_u, bus_v)
+    _, last = np.unique(bus_keys[::-1], return_index=True)
+    last = np.sort(len(bus_keys) - 1 - last)
+    bus_u, bus_v, bus_length, bus_duration, bus_id, bus_keys = (
+        np.asarray(a)[last] for a in (bus_u, bus_v, bus_length, bus_duration,
+                                      bus_id, bus_keys))
+    walk_u, walk_v, walk_length = graph.edges()
+    # Drop the walking edges that have a bus edge between their nodes
+    keep = ~np.isin(walk_u * n + walk_v, bus_keys)
+    u = np.concatenate((walk_u[keep], bus_u))
+    v = np.concatenate((walk_v[keep], bus_v))
+    length = np.concatenate((walk_length[keep], bus_length))
+    duration = np.concatenate((walk_length[keep] / WALKING_SPEED,
+                               bus_duration))
+    edge_bus = np.concatenate((np.full(keep.sum(), -1), bus_id))
+    # Both directions, sorted by source and target
+    src = np.concatenate((u, v))
+    dst = np.concatenate((v, u))
+    order = np.lexsort((dst, src))
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(src, minlength=n), out=indptr[1:])
+    return (indptr, dst[order].astype(np.int32),
+            np.concatenate((duration, duration))[order],
+            np.concatenate((length, length))[order],
+            np.concatenate((edge_bus, edge_bus))[order])
+
+
+def save_network(network, folder):
+    """ Save the arrays of network_arrays in folder."""
+    save_arrays(folder, NETWORK_ARRAYS, network)
+
+
+def load_network(folder, mmap_mode='r'):
+    """ Return the arrays of network_arrays saved in folder."""
+    return tuple(load_arrays(folder, NETWORK_ARRAYS, mmap_mode))
+
+
+def tree_statistics(predecessors, rows, targets, network,
+                    return_paths=False):
+    """Return the buses taken, the unique buses, the bus ride distance and
+    the walking distance of the paths to the node positions targets in the
+    shortest path trees predecessors[rows] of the network arrays, counted
+    like path_statistics.
+
+    The paths are traced back all at once. A bus is taken at a bus edge
+    that follows a walking edge or starts the path. With return_paths the
+    (path, bus_id) pairs of the buses taken and the (path, stop) pairs of
+    the nodes of the bus edges on the paths are also returned, as 4 arrays
+    sorted by path.
+    """
+    indptr, indices, _, length, bus_id = network
+    n = len(indptr) - 1
+    edge_keys = np.repeat(np.arange(n), np.diff(indptr)) * n + indices
+    m = len(targets)
+    paths = np.arange(m)
+    buses = np.zeros(m, dtype=np.int64)
+    taken = np.zeros((m, int(np.max(bus_id, initial=-1)) + 1), dtype=bool)
+    bus_ride_distance = np.zeros(m)
+    walking_distance = np.zeros(m)
+    node = np.array(targets, dtype=np.int64)
+    # Bus of the edge after the current one, -1 for walking
+    next_bus = np.full(m, -1)
+    stop_keys = []
+    active = predecessors[rows, node] >= 0
+    while active.any():
+        p = paths[active]
+        pred = predecessors[rows[p], node[p]]
+        e = np.searchsorted(edge_keys, pred.astype(np.int64) * n + node[p])
+        bus = bus_id[e]
+        on_bus = bus >= 0
+        if return_paths:
+            stop_keys += [p[on_bus] * n + node[p[on_bus]],
+                          p[on_bus] * n + pred[on_bus]]
+        bus_ride_distance[p] += np.where(on_bus, length[e], 0)
+        walking_distance[p] += np.where(on_bus, 0, length[e])
+        boarded = p[(next_bus[p] >= 0) & ~on_bus]
+        taken[boarded, next_bus[boarded]] = True
+        buses[boarded] += 1
+        next_bus[p] = bus
+        node[p] = pred
+        active = predecessors[rows, node] >= 0
+    boarded = paths[next_bus >= 0]
+    taken[boarded, next_bus[boarded]] = True
+    buses[boarded] += 1
+    statistics = (buses, taken.sum(axis=1), bus_ride_distance,
+                  walking_distance)
+    if not return_paths:
+        return statistics
+    bus_paths, bus_ids = np.nonzero(taken)
+    stop_keys = np.unique(np.concatenate(
+        stop_keys + [np.array([], dtype=np.int64)]))
+    return statistics + (bus_paths, bus_ids, stop_keys // n, stop_keys % n)
+
+
+def evaluate_trips(network_folder, origins, destinations,
+                   return_paths=False):
+    """Return the statistics of path_statistics for the trips between the
+    node positions origins and destinations, as 5 arrays, and with
+    return_paths the pairs of tree_statistics.
+
+    One Dijkstra runs from each distinct origin over the network arrays saved
+    in network_folder, which are memory mapped so that the processes of a
+    pool share them.
+    """
+    return evaluate_network(load_network(network_folder), origins,
+                            destinations, return_paths)
+
+
+def evaluate_network(network, origins, destinations, return_paths=False):
+    """Return the statistics of evaluate_trips for the network arrays, and
+    with return_paths the pairs of tree_statistics.
+    """
+    indptr, indices, duration = network[:3]
+    n = len(indptr) - 1
+    unique_origins, rows = np.unique(origins, return_inverse=True)
+    rows = rows.ravel()
+    dist, predecessors = csgraph.dijkstra(
+        sparse.csr_matrix((duration, indices, indptr), shape=(n, n)),
+        indices=unique_origins, return_predecessors=True)
+    return (dist[rows, destinations],) + \
+        tree_statistics(predecessors, rows, destinations, network,
+                        return_paths)
+
+
+# Names of the arrays saved by save_trip_paths : the trips, their durations,
+# the (trip, bus_id) and (trip, stop) pairs of their paths and the bus edges
+# they were evaluated with
+TRIP_PATH_ARRAYS = ('origins', 'destinations', 'duration', 'bus_trips',
+                    'bus_ids', 'stop_trips', 'stops') + \
+    tuple('edge_' + name for name in BUS_EDGE_ARRAYS)
+
+
+def save_trip_paths(folder, arrays):
+    """Save the arrays of TRIP_PATH_ARRAYS in folder, replacing the ones
+    saved before only once they are all written.
+    """
+    folder = str(folder)
+    parent = os.path.dirname(os.path.abspath(folder))
+    os.makedirs(parent, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=parent)
+    save_arrays(tmp_dir, TRIP_PATH_ARRAYS, arrays)
+    if os.path.isdir(folder):
+        shutil.rmtree(folder)
+    os.rename(tmp_dir, folder)
+
+
+def load_trip_paths(folder):
+    """ Return the arrays saved by save_trip_paths, None if there are none."""
+    if not os.path.isdir(str(folder)):
+        return None
+    return load_arrays(folder, TRIP_PATH_ARRAYS, mmap_mode=None)
+
+
+def changed_edges(graph, old_edges, new_edges):
+    """Return the bus_ids of the bus edges that differ between old_edges and
+    new_edges, and the edges of the graph that change with them as the
+    arrays u, v and duration.
+
+    Between the same nodes only the last bus edge counts, like in
+    network_arrays. An edge changes when only one of old_edges and new_edges
+    has a bus edge between its nodes, which then replaces the walking edge,
+    or when their lengths or bus_ids differ. Its duration is the shortest of
+    the edges between its nodes before and after the change.
+    """
+    def last_edges(edges):
+        u, v, length, duration, bus_id = (np.asarray(a).tolist()
+                                          for a in edges)
+        return {(min(a, b), max(a, b)): (l, d, bus)
+                for a, b, l, d, bus in zip(u, v, length, duration, bus_id)}
+
+    old = last_edges(old_edges)
+    new = last_edges(new_edges)
+    changed = sorted(nodes for nodes in set(old) | set(new)
+                     if old.get(nodes) != new.get(nodes))
+    buses = {edges[nodes][2] for edges in (old, new) for nodes in changed
+             if nodes in edges}
+    u = np.array([a for a, _ in changed], dtype=np.int64)
+    v = np.array([b for _, b in changed], dtype=np.int64)
+    duration = np.array([min(old.get(nodes, (0, np.inf))[1],
+                             new.get(nodes, (0, np.inf))[1])
+                         for nodes in changed])
+    # The walking edge between the nodes of a bus edge that only one of
+    # them has
+    walking = np.array([(nodes in old) != (nodes in new) for nodes in changed],
+                       dtype=bool)
+    n = len(graph)
+    edge_keys = np.repeat(np.arange(n), np.diff(graph.indptr)) * n + \
+        graph.indices
+    keys = u[walking] * n + v[walking]
+    e = np.minimum(np.searchsorted(edge_keys, keys), len(edge_keys) - 1)
+    road = edge_keys[e] == keys
+    duration[np.flatnonzero(walking)[road]] = np.minimum(
+        duration[walking][road],
+        np.asarray(graph.length)[e[road]] / WALKING_SPEED)
+    return np.array(sorted(buses), dtype=np.int64), u, v, duration
+
+
+def affected_trips(graph, trip_paths, edges):
+    """Return the mask of the trips of trip_paths (see save_trip_paths) that
+    may change with the bus edges.
+
+    A trip is affected if its path took a changed bus, or if a path over one
+    of the edges of changed_edges could be as short as its duration. Only
+    those paths lose or gain an edge, and such a path takes at least the
+    straight line to one end of the edge and from the other end to the
+    destination at MAX_SPEED, plus the duration of the edge.
+    """
+    origins, destinations, duration, bus_trips, bus_ids = trip_paths[:5]
+    buses, u, v, edge_duration = changed_edges(graph, trip_paths[7:], edges)
+    affected = np.zeros(len(origins), dtype=bool)
+    affected[bus_trips[np.isin(bus_ids, buses)]] = True
+    lon, lat = graph.lon, graph.lat
+    lower_bound = np.full(len(origins), np.inf)
+    for a, b, edge in zip(u, v, edge_duration):
+        to_a, to_b = (OSMParser.haversine(lon[origins], lat[origins],
+                                          lon[x], lat[x]) for x in (a, b))
+        from_a, from_b = (OSMParser.haversine(lon[x], lat[x],
+                                              lon[destinations],
+                                              lat[destinations])
+                          for x in (a, b))
+        np.minimum(lower_bound, np.minimum(to_a + from_b, to_b + from_a) /
+                   MAX_SPEED + edge, out=lower_bound)
+    return affected | (lower_bound <= duration)
+
+
+def merge_pairs(trips, values, update, new_trips, new_values):
+    """Return the (trip, value) pairs with the pairs of the trips in the mask
+    update replaced by the new ones, new_trips being indices into
+    np.flatnonzero(update). The pairs are sorted by trip.
+    """
+    keep = ~update[trips]
+    trips = np.concatenate((trips[keep], np.flatnonzero(update)[new_trips]))
+    values = np.concatenate((values[keep], new_values))
+    order = np.argsort(trips, kind='mergesort')
+    return trips[order], values[order]
+
+
+class TransitMatrix:
+    """Travel times between the bus stops of the walking + bus graph.
+
+    The stops are the nodes of the bus edges. For the stop i :
+    walk[i] holds the walking durations (s) from the stop to every node of
+    the graph, using only walking edges, and ride[i] the durations to the
+    other stops using any edge. The ride_* arrays hold the statistics of the
+    paths between the stops : bus ride distance, walking distance, buses
+    taken and unique buses, counted like BusNetwork.path_statistics.
+
+    A trip from o to d either walks all the way or walks to a stop i, goes
+    to a stop j and walks to d, so its duration is
+    min(walk only, min over i, j of walk[i, o] + ride[i, j] + walk[j, d]),
+    the same as the shortest path on the graph.
+    """
+    ARRAYS = ('stops', 'walk', 'ride', 'ride_distance', 'ride_walking',
+              'ride_buses', 'ride_unique_buses')
+
+    def __init__(self, graph, edges, arrays=None):
+        self.graph = graph
+        self.network = network_arrays(graph, edges)
+        indptr, indices, duration, _, bus_id = self.network
+        n = len(graph)
+        self.network_csr = sparse.csr_matrix((duration, indices, indptr),
+                                             shape=(n, n))
+        # The walking graph without the edges replaced by bus edges
+        src = np.repeat(np.arange(n), np.diff(indptr))
+        walking = bus_id < 0
+        self.walking_csr = sparse.csr_matrix(
+            (duration[walking], (src[walking], indices[walking])),
+            shape=(n, n))
+        if arrays is None:
+            arrays = self._build(np.unique(np.concatenate(edges[:2])))
+        for name, array in zip(self.ARRAYS, arrays):
+            setattr(self, name, array)
+
+    def _build(self, stops):
+        walk = csgraph.dijkstra(self.walking_csr, indices=stops)
+        dist, predecessors = csgraph.dijkstra(self.network_csr, indices=stops,
+                                              return_predecessors=True)
+        ride = dist[:, stops]
+        # The paths from every stop to every stop
+        k = len(stops)
+        ride_buses, ride_unique_buses, ride_distance, ride_walking = (
+            stat.reshape(k, k) for stat in tree_statistics(
+                predecessors, np.repeat(np.arange(k), k), np.tile(stops, k),
+                self.network))
+        return (stops, walk, ride, ride_distance, ride_walking, ride_buses,
+                ride_unique_buses)
+
+    @classmethod
+    def cached(cls, graph, edges, cache_dir, mmap_mode='r'):
+        """Return the TransitMatrix of the graph and bus edges, built once and
+        saved in cache_dir under the hash of its inputs.
+        """
+        key = arrays_hash(graph.node_ids, graph.indptr, graph.indices,
+                          graph.length, *edges)
+        matrix_dir = os.path.join(str(cache_dir), key)
+        if os.path.isdir(matrix_dir):
+            return cls(graph, edges,
+                       load_arrays(matrix_dir, cls.ARRAYS, mmap_mode))
+        matrix = cls(graph, edges)
+        cache_arrays(cache_dir, key, cls.ARRAYS,
+                     [getattr(matrix, name) for name in cls.ARRAYS])
+        return matrix
+
+    def trip_statistics(self, origins, destinations):
+        """Return the statistics of path_statistics for the trips between the
+        node positions origins and destinations, as 5 arrays.
+        """
+        n_trips = len(origins)
+        duration = np.empty(n_trips)
+        buses = np.zeros(n_trips, dtype=np.int64)
+        unique_buses = np.zeros(n_trips, dtype=np.int64)
+        bus_ride_distance = np.zeros(n_trips)
+        walking_distance = np.empty(n_trips)
+        lon, lat = self.graph.lon, self.graph.lat
+        unique_origins, inverse = np.unique(origins, return_inverse=True)
+        inverse = inverse.ravel()
+        trip_order = np.argsort(inverse, kind='mergesort')
+        group_ends = np.cumsum(np.bincount(inverse,
+                                           minlength=len(unique_origins)))
+        for o, trips in zip(unique_origins,
+                            np.split(trip_order, group_ends[:-1])):
+            d = destinations[trips]
+            # Best boarding stop i for every alighting stop j
+            via = self.walk[:, o][:, None] + self.ride
+            board = np.argmin(via, axis=0)
+            via = via[board, np.arange(len(board))]
+            # Best alighting stop for every destination
+            total = via[:, None] + self.walk[:, d]
+            alight = np.argmin(total, axis=0)
+            transit = total[alight, np.arange(len(d))]
+            i = board[alight]
+            duration[trips] = transit
+            buses[trips] = self.ride_buses[i, alight]
+            unique_buses[trips] = self.ride_unique_buses[i, alight]
+            bus_ride_distance[trips] = self.ride_distance[i, alight]
+            walking_distance[trips] = \
+                (self.walk[i, o] + self.walk[alight, d]) * WALKING_SPEED + \
+                self.ride_walking[i, alight]
+
+            # Walk only when it is not longer, only searching when the
+            # straight line walk is shorter than the ride
+            lower_bound = OSMParser.haversine(lon[o], lat[o], lon[d], lat[d])
+            search = lower_bound / WALKING_SPEED <= transit
+            if search.any():
+                walk = csgraph.dijkstra(self.walking_csr, indices=o,
+                                        limit=transit[search].max())
+                walk = walk[d]
+                walk_only = search & (walk <= transit)
+                t = trips[walk_only]
+                duration[t] = walk[walk_only]
+                buses[t] = 0
+                unique_buses[t] = 0
+                bus_ride_distance[t] = 0
+                walking_distance[t] = walk[walk_only] * WALKING_SPEED
+        return (duration, buses, unique_buses, bus_ride_distance,
+                walking_distance)
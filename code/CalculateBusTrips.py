@@ -1,9 +1,15 @@
-from itertools import islice
+from multiprocessing import Pool
 from pathlib import Path
+import shutil
+import tempfile
 import matplotlib.pyplot as plt
 import matplotlib.colors
+import BusNetwork
 import OSMParser
+import TransitRouter
+import TripStore
 import networkx as nx
+import numpy as np
 import pandas as pd
 
 # Path to local data
@@ -13,110 +19,236 @@ dataset = 'sample'
 dataset_folder = local_data_folder / dataset
 
 osm_file = local_data_folder / 'map.osm'
-# Read the OSM as a directed graph
-G = OSMParser.read_osm(str(osm_file))
-# We convert to undirected graph because a bus stop may have been placed in
-# a dead end.
-G = G.to_undirected()
-# We get the giant component because our graph has many components
-# so we may not be able to get from some point A to point B
-G = max(nx.connected_component_subgraphs(G), key=len)
-
-# Average walking speed 1.2m/s
-# https://journals.sagepub.com/doi/pdf/10.1177/0361198106198200104
-# Add the duration to travel each edge
-for u, v, d in G.edges(data=True):
-    d['duration'] = d['length'] / 1.2
-
-# Read the bus routes
+# Read the OSM as an undirected graph because a bus stop may have been
+# placed in a dead end. We get the giant component because our graph has
+# many components so we may not be able to get from some point A to point B.
+# The compiled graph is cached so only the first run parses the xml.
+graph = OSMParser.compile_osm(str(osm_file))
+
+# The bus routes
 bus_routes_csv = dataset_folder / 'bus_routes.csv'
-bus_routes_df = pd.read_csv(bus_routes_csv)
-# Read the bus stops
+# The bus stops
 bus_stops_csv = dataset_folder / 'bus_stops_relocated_with_buses.csv'
-bus_stops_df = pd.read_csv(bus_stops_csv)
 # Read the trips, relocating them all would take much time so we test with
-# the sample trips
-trips_csv = local_data_folder / 'sample_relocated_trips.csv'
-trips_df = pd.read_csv(trips_csv)
+# the sample trips. Format of the trips file, 'csv' or 'parquet'
+trips_format = 'csv'
+trips_csv = TripStore.trips_path(local_data_folder, 'sample_relocated_trips',
+                                 trips_format)
 
 # File to save the output
 trips_w_bus = dataset_folder / 'sample_relocated_trips_with_bus.csv'
+# Evaluate the trips with one Dijkstra from each distinct pickup node and
+# read the paths to all its dropoff nodes from the shortest path tree,
+# otherwise one search runs for every trip. The paths are the same.
+BATCH_EVALUATION = True
+# Search for the trips when they are not evaluated in batch, 'dijkstra',
+# 'astar' or 'bidirectional' (see BusNetwork.py). The number of settled nodes
+# is printed to compare them.
+ROUTING = 'dijkstra'
+# Answer the trips from the travel times between the bus stops instead
+# (see BusNetwork.TransitMatrix), which are computed once and saved in
+# transit_cache_folder. The durations are the same as with the searches.
+TRANSIT_MATRIX = False
+transit_cache_folder = dataset_folder / 'transit_cache'
+# Route the trips over the bus stops with the round-based transit router
+# instead (see TransitRouter.py). The buses of every route leave its first
+# stop every HEADWAY seconds and a trip takes at most MAX_BUSES buses, the
+# durations include the waiting at the stops. The trips leave at their pickup
+# time of day when they have a pickup_datetime, otherwise at 0.
+RAPTOR = False
+HEADWAY = 600
+MAX_BUSES = 4
+raptor_cache_folder = dataset_folder / 'raptor_cache'
+# Only evaluate again the trips that a change of the bus routes may affect
+# (see BusNetwork.affected_trips) and update their rows of trips_w_bus. The
+# paths of the trips are saved in trip_paths_folder, a run without them
+# evaluates all the trips.
+INCREMENTAL_EVALUATION = False
+trip_paths_folder = dataset_folder / 'trip_paths'
+# Folder of the cached bus edges
+bus_edges_folder = dataset_folder / 'bus_edges_cache'
+# Evaluate the trips in a pool of N_PROCESSES processes (None for one per
+# core), ORIGINS_PER_CHUNK pickup nodes at a time. The walking + bus graph is
+# saved as arrays which the processes memory map. The incremental evaluation
+# also uses the pool.
+PARALLEL_EVALUATION = False
+N_PROCESSES = None
+ORIGINS_PER_CHUNK = 100
+
+
+def tree_path(pred, target):
+    """Return the path to target in the shortest path tree pred returned by
+    nx.dijkstra_predecessor_and_distance. The first predecessor of a node is
+    the one nx.dijkstra_path takes, so the path is the same.
+    """
+    path = [target]
+    while pred[path[-1]]:
+        path.append(pred[path[-1]][0])
+    return path[::-1]
+
+
+# The edges between bus stops with the appropriate weights, they are built
+# once for the routes and stops and then loaded from bus_edges_folder
+bus_edges = BusNetwork.bus_overlay(graph, bus_routes_csv, bus_stops_csv,
+                                   bus_edges_folder)
+
+def origin_chunks(origins):
+    """Return the indices of origins sorted by origin, in chunks of
+    ORIGINS_PER_CHUNK distinct origins.
+    """
+    order = np.argsort(origins, kind='mergesort')
+    origin_starts = np.flatnonzero(np.diff(origins[order])) + 1
+    chunks = np.split(order, origin_starts[ORIGINS_PER_CHUNK - 1::
+                                           ORIGINS_PER_CHUNK])
+    return [chunk for chunk in chunks if len(chunk)]
+
+
+def evaluate_chunks(origins, destinations, return_paths=False):
+    """Evaluate the trips over the walking + bus graph arrays, one chunk of
+    origin_chunks at a time so that the shortest path trees of only
+    ORIGINS_PER_CHUNK origins are in memory. With PARALLEL_EVALUATION the
+    chunks go to a pool. Returns the chunks and the results of
+    BusNetwork.evaluate_trips for each of them.
+    """
+    chunks = origin_chunks(origins)
+    network = BusNetwork.network_arrays(graph, bus_edges)
+    if PARALLEL_EVALUATION:
+        network_folder = tempfile.mkdtemp(dir=str(dataset_folder))
+        BusNetwork.save_network(network, network_folder)
+        with Pool(N_PROCESSES) as pool:
+            results = pool.starmap(BusNetwork.evaluate_trips,
+                                   [(network_folder, origins[chunk],
+                                     destinations[chunk], return_paths)
+                                    for chunk in chunks])
+        shutil.rmtree(network_folder)
+    else:
+        results = [BusNetwork.evaluate_network(network, origins[chunk],
+                                               destinations[chunk],
+                                               return_paths)
+                   for chunk in chunks]
+    return chunks, results
 
-# The following loop adds edges between bus stops with the appropriate weights
-grouped_routes = bus_routes_df.groupby('bus_id')
-for bus_id, group in grouped_routes:
-    # The current_bus_stops are the stops of the bus_id but unordered
-    current_bus_stops = bus_stops_df.loc[bus_stops_df['bus_id'] == bus_id]
-    current_bus_stops_nodes = list(map(str, current_bus_stops['node_id']))
-    # Save the starting stop
-    initial_bus_stop_node = str(group.iloc[0]['route_nodes'])
-
-    # Create a list of all the unvisited stops so far
-    unvisited_bus_stops = current_bus_stops_nodes
-    unvisited_bus_stops.remove(initial_bus_stop_node)
-
-    # Calculate the length and duration between 2 bus stops
-    # and add an edge between those 2 nodes in our graph G
-    length_btw_stops = 0
-    previous_bus_stop = initial_bus_stop_node
-    previous_node = initial_bus_stop_node
-    # Iterate over all the nodes in the route but not the first
-    for idx, row in islice(group.iterrows(), 1, None):
-        current_node = str(row['route_nodes'])
-        length_btw_stops += G.edge[previous_node][current_node]['length']
-        if current_node in unvisited_bus_stops:
-            # Average Manhattan bus speed 2.5m/s
-            duration = length_btw_stops / 2.5
-            G.add_edge(previous_bus_stop, current_node,
-                       {'length': length_btw_stops, 'duration': duration,
-                        'bus_id': bus_id})
-            length_btw_stops = 0
-            unvisited_bus_stops.remove(current_node)
-            if len(unvisited_bus_stops) == 0:
-                unvisited_bus_stops.append(initial_bus_stop_node)
-            previous_bus_stop = current_node
-        previous_node = current_node
-# Now our graph G has edges from one bus stop to the other with the
-# related length and duration as attributes
-
-# Calculate trip distances
-for idx, row in trips_df.iterrows():
-    pickup_node = str(row['pickup_node'])
-    dropoff_node = str(row['dropoff_node'])
-    path = nx.dijkstra_path(G, source=pickup_node,
-                                 target=dropoff_node,
-                                 weight='duration')
-    total_duration = 0
-    walking_distance = 0
-    bus_ride_distance = 0
-    buses_used = 0
-    unique_buses = []
-    # Save previous method of transportation
-    walking_flag = True
-    for u, v in zip(path, path[1:]):
-        edge_data = G.get_edge_data(u, v)
-        total_duration += edge_data['duration']
-        if 'bus_id' in edge_data:
-            bus_ride_distance += edge_data['length']
+
+# Columns of the trip statistics
+stat_columns = ['bus_duration', 'buses', 'unique_buses', 'bus_ride_distance',
+                'walking_distance']
+
+# The pool re-imports this module in its processes, so the trips are only
+# read and evaluated from the main one
+if __name__ == '__main__':
+    trips_df = TripStore.read_trips(trips_csv)
+
+    # Calculate trip distances
+    if RAPTOR:
+        router = TransitRouter.TransitRouter.cached(
+            graph, bus_edges, raptor_cache_folder, headway=HEADWAY,
+            max_buses=MAX_BUSES)
+        departures = None
+        if 'pickup_datetime' in trips_df:
+            pickup_time = pd.to_datetime(trips_df['pickup_datetime'])
+            departures = (pickup_time - pickup_time.dt.normalize()) \
+                .dt.total_seconds().values
+        trip_stats = router.trip_statistics(
+            graph.positions(trips_df['pickup_node'].values),
+            graph.positions(trips_df['dropoff_node'].values), departures)
+    elif INCREMENTAL_EVALUATION:
+        origins = graph.positions(trips_df['pickup_node'].values)
+        destinations = graph.positions(trips_df['dropoff_node'].values)
+        trip_paths = BusNetwork.load_trip_paths(trip_paths_folder)
+        # The saved paths are only of use for the same trips
+        if trip_paths is not None and trips_w_bus.exists() and \
+                np.array_equal(trip_paths[0], origins) and \
+                np.array_equal(trip_paths[1], destinations):
+            update = BusNetwork.affected_trips(graph, trip_paths, bus_edges)
+            trips_w_bus_df = pd.read_csv(trips_w_bus)
+            trip_stats = [trips_w_bus_df[column].values.astype(float)
+                          for column in stat_columns]
         else:
-            walking_distance += edge_data['length']
-        if 'bus_id' in edge_data and walking_flag:
-            buses_used += 1
-            walking_flag = False
-            bus_id = edge_data['bus_id']
-            if not(bus_id in unique_buses):
-                unique_buses.append(bus_id)
-        if not('bus_id' in edge_data) and not(walking_flag):
-            walking_flag = True
-    trips_df.at[idx, 'bus_duration'] = total_duration
-    trips_df.at[idx, 'buses'] = buses_used
-    trips_df.at[idx, 'unique_buses'] = len(unique_buses)
-    trips_df.at[idx, 'bus_ride_distance'] = bus_ride_distance
-    trips_df.at[idx, 'walking_distance'] = walking_distance
-
-trips_df['bus_duration'] = trips_df['bus_duration'].astype(int)
-trips_df['buses'] = trips_df['buses'].astype(int)
-trips_df['unique_buses'] = trips_df['unique_buses'].astype(int)
-trips_df['bus_ride_distance'] = trips_df['bus_ride_distance'].astype(int)
-trips_df['walking_distance'] = trips_df['walking_distance'].astype(int)
-trips_df.to_csv(trips_w_bus, index=False)
+            update = np.ones(len(trips_df), dtype=bool)
+            trip_paths = [origins, destinations, np.empty(len(trips_df))] + \
+                [np.array([], dtype=np.int64)] * 4
+            trip_stats = [np.empty(len(trips_df)) for _ in stat_columns]
+        print('Evaluating ' + str(update.sum()) + ' of ' +
+              str(len(update)) + ' trips')
+        updated = np.flatnonzero(update)
+        chunks, results = evaluate_chunks(origins[updated],
+                                          destinations[updated],
+                                          return_paths=True)
+        duration = trip_paths[2].copy()
+        # The (trip, bus_id) and (trip, stop) pairs of the new paths, the
+        # trips being indices into updated
+        new_pairs = [[np.array([], dtype=np.int64)] for _ in range(4)]
+        for chunk, result in zip(chunks, results):
+            for stat, values in zip(trip_stats, result[:5]):
+                stat[updated[chunk]] = values
+            duration[updated[chunk]] = result[0]
+            for pairs, values in zip(new_pairs, (chunk[result[5]], result[6],
+                                                 chunk[result[7]], result[8])):
+                pairs.append(values)
+        new_pairs = [np.concatenate(pairs) for pairs in new_pairs]
+        # Save the paths for the next change
+        bus_trips, bus_ids = BusNetwork.merge_pairs(
+            trip_paths[3], trip_paths[4], update, *new_pairs[:2])
+        stop_trips, stops = BusNetwork.merge_pairs(
+            trip_paths[5], trip_paths[6], update, *new_pairs[2:])
+        BusNetwork.save_trip_paths(
+            trip_paths_folder, (origins, destinations, duration, bus_trips,
+                                bus_ids, stop_trips, stops) + tuple(bus_edges))
+    elif TRANSIT_MATRIX:
+        transit_matrix = BusNetwork.TransitMatrix.cached(
+            graph, bus_edges, transit_cache_folder)
+        trip_stats = transit_matrix.trip_statistics(
+            graph.positions(trips_df['pickup_node'].values),
+            graph.positions(trips_df['dropoff_node'].values))
+    elif PARALLEL_EVALUATION:
+        chunks, results = evaluate_chunks(
+            graph.positions(trips_df['pickup_node'].values),
+            graph.positions(trips_df['dropoff_node'].values))
+        # Put the results back in the order of the trips
+        trip_stats = [np.empty(len(trips_df)) for _ in range(5)]
+        for chunk, result in zip(chunks, results):
+            for stat, values in zip(trip_stats, result):
+                stat[chunk] = values
+    else:
+        # Only the searches with networkx need the graph G
+        G = graph.to_networkx()
+        # Average walking speed 1.2m/s
+        # https://journals.sagepub.com/doi/pdf/10.1177/0361198106198200104
+        # Add the duration to travel each edge
+        for u, v, d in G.edges(data=True):
+            d['duration'] = d['length'] / 1.2
+        # Add the edges between bus stops, now our graph G has edges from
+        # one bus stop to the other with the related length and duration as
+        # attributes
+        BusNetwork.add_bus_edges(G, graph, bus_edges)
+
+        if BATCH_EVALUATION:
+            # One search from each pickup node for all of its trips
+            trip_paths = {}
+            for pickup_node, trips in trips_df.groupby('pickup_node'):
+                pred, _ = nx.dijkstra_predecessor_and_distance(
+                    G, str(pickup_node), weight='duration')
+                for idx, dropoff_node in trips['dropoff_node'].items():
+                    trip_paths[idx] = tree_path(pred, str(dropoff_node))
+            trip_paths = [trip_paths[idx] for idx in trips_df.index]
+        else:
+            trip_paths = []
+            settled_nodes = 0
+            for idx, row in trips_df.iterrows():
+                path, settled = BusNetwork.ROUTINGS[ROUTING](
+                    G, str(row['pickup_node']), str(row['dropoff_node']))
+                trip_paths.append(path)
+                settled_nodes += settled
+            print('Settled nodes with ' + ROUTING + ': ' + str(settled_nodes))
+        trip_stats = zip(*(BusNetwork.path_statistics(G, path)
+                           for path in trip_paths))
+
+    for column, values in zip(stat_columns, trip_stats):
+        trips_df[column] = values
+
+    trips_df['bus_duration'] = trips_df['bus_duration'].astype(int)
+    trips_df['buses'] = trips_df['buses'].astype(int)
+    trips_df['unique_buses'] = trips_df['unique_buses'].astype(int)
+    trips_df['bus_ride_distance'] = trips_df['bus_ride_distance'].astype(int)
+    trips_df['walking_distance'] = trips_df['walking_distance'].astype(int)
+    trips_df.to_csv(trips_w_bus, index=False)
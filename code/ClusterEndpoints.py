@@ -9,14 +9,18 @@ import matplotlib.pyplot as plt
 import numpy as np
 from sklearn import cluster
 import OSMParser
+import TripStore
 
 # Path to local data folder
 local_data_folder = Path('../data/')
 # Choose which dataset to work with
 dataset = 'sample'
+# Format of the trips file, 'csv' or 'parquet'
+trips_format = 'csv'
 # The trips file which we will process
-trips_file = local_data_folder / (
-            'trips.01-11-2013.07-11-2013.' + dataset + '.csv')
+trips_file = TripStore.trips_path(local_data_folder,
+                                  'trips.01-11-2013.07-11-2013.' + dataset,
+                                  trips_format)
 dataset_folder = local_data_folder / dataset
 # File to save bus stop locations
 bus_stops_output_file = dataset_folder / 'bus_stops.csv'
@@ -24,37 +28,248 @@ bus_stops_output_file = dataset_folder / 'bus_stops.csv'
 map_plot_output_file = dataset_folder / 'trips_and_stops_map.eps'
 # File to the 90th percentile distance for n number of buses
 n_stops_p_output_file = dataset_folder / 'n_stops_90th_perc.csv'
+# Clustering mode, 'kmeans' loads all the endpoints and runs KMeans.
+# 'minibatch' streams the trips file in chunks of CHUNK_SIZE trips and runs
+# MiniBatchKMeans with batches of BATCH_SIZE endpoints for N_EPOCHS passes,
+# so the memory is bounded for the full dataset. The walking distance
+# percentile is then taken from a histogram with DIST_RESOLUTION m bins.
+CLUSTERING_MODE = 'kmeans'
+CHUNK_SIZE = 1000000
+BATCH_SIZE = 10000
+N_EPOCHS = 2
+DIST_RESOLUTION = 0.1
+MAX_DIST = 50000
+# Search of the number of stops, 'linear' fits 40, 45, 50, ... stops until
+# the 90th percentile walking distance is less than 400m. 'bisect' doubles
+# the step until that distance is reached and then bisects the bracket, every
+# fit is warm started from the centroids of the closest number of stops
+SEARCH_MODE = 'linear'
+# Bin the endpoints into a grid of GRID_CELL_SIZE m cells and cluster the
+# occupied cells weighted by their number of endpoints, instead of the
+# endpoints themselves. In 'minibatch' mode the cells are found from the
+# streamed endpoints and then clustered in memory with KMeans
+GRID_AGGREGATION = False
+GRID_CELL_SIZE = 10
+
+
+def walking_distances(lon, lat, centers, labels):
+    """Return the Manhattan distance (m) from every endpoint (lon, lat arrays)
+    to the bus stop (cluster center) of its label, computed in one go.
+    """
+    assigned = centers[labels]
+    # Calculate the distance in metres using the haversine formula
+    # https://en.wikipedia.org/wiki/Haversine_formula
+    return OSMParser.manhattan_distance(assigned[:, 0], assigned[:, 1],
+                                        lon, lat)
+
+
+def weighted_percentile(values, weights, q):
+    """ Percentile q of values, with every value counted weights times."""
+    order = np.argsort(values)
+    cum_weights = np.cumsum(weights[order])
+    return values[order][np.searchsorted(cum_weights,
+                                         q / 100 * cum_weights[-1])]
+
+
+def iter_endpoints():
+    """Yield the endpoints (pickups and dropoffs) of the trips file as
+    float64 (longitude, latitude) arrays of at most 2 * CHUNK_SIZE rows.
+    """
+    for chunk in TripStore.iter_trips(trips_file,
+                                      columns=['pickup_longitude',
+                                               'pickup_latitude',
+                                               'dropoff_longitude',
+                                               'dropoff_latitude'],
+                                      chunksize=CHUNK_SIZE):
+        yield np.concatenate(
+            (chunk[['pickup_longitude', 'pickup_latitude']].values,
+             chunk[['dropoff_longitude', 'dropoff_latitude']].values)
+        ).astype(np.float64)
+
+
+def aggregate_endpoints(chunks):
+    """Bin the endpoints of chunks into a grid of GRID_CELL_SIZE m cells.
+    Returns the mean location and the number of endpoints of every occupied
+    cell.
+    """
+    cells = np.empty((0, 2), dtype=np.int64)
+    # Number of endpoints and sums of their longitudes and latitudes
+    sums = np.empty((0, 3))
+    cell_deg = None
+    for chunk in chunks:
+        if cell_deg is None:
+            # Size of the cells in degrees around the first endpoints
+            lat_deg = GRID_CELL_SIZE / OSMParser.haversine(0, 0, 0, 1)
+            cell_deg = np.array([lat_deg / np.cos(np.radians(chunk[0, 1])),
+                                 lat_deg])
+        cells = np.concatenate(
+            (cells, np.floor(chunk / cell_deg).astype(np.int64)))
+        sums = np.concatenate(
+            (sums, np.column_stack((np.ones(len(chunk)), chunk))))
+        # Merge the endpoints of the same cell
+        cells, inverse = np.unique(cells, axis=0, return_inverse=True)
+        sums = np.column_stack(
+            [np.bincount(inverse.ravel(), weights=sums[:, i],
+                         minlength=len(cells)) for i in range(3)])
+    return sums[:, 1:] / sums[:, :1], sums[:, 0]
+
+
+def fit_kmeans(n_clusters, init='k-means++'):
+    """Fit KMeans on the endpoints. Returns the fitted model, the 90th
+    percentile of the walking distance to the stops and the number of
+    endpoints and total walking distance of every stop.
+    """
+    # A warm start is a single run from the given centroids
+    K_means = cluster.KMeans(n_clusters=n_clusters, init=init,
+                             n_init=4 if isinstance(init, str) else 1,
+                             random_state=r_state, n_jobs=-1)
+    centroids = K_means.fit(endpoints_xy, sample_weight=endpoint_weights)
+
+    # Store the Manhattan distance from the endpoints
+    # to the bus stops, for all the endpoints at once
+    manh_dist = walking_distances(endpoints_lon, endpoints_lat,
+                                  centroids.cluster_centers_,
+                                  centroids.labels_)
+
+    if endpoint_weights is None:
+        nnth_percentile = np.percentile(manh_dist, 90)
+    else:
+        nnth_percentile = weighted_percentile(manh_dist, endpoint_weights, 90)
+    return (centroids, nnth_percentile,
+            np.bincount(centroids.labels_, weights=endpoint_weights,
+                        minlength=n_clusters),
+            np.bincount(centroids.labels_,
+                        weights=manh_dist if endpoint_weights is None
+                        else manh_dist * endpoint_weights,
+                        minlength=n_clusters))
+
+
+def fit_minibatch(n_clusters, init='k-means++'):
+    """Fit MiniBatchKMeans on the streamed endpoints. Returns the same as
+    fit_kmeans, the percentile is read from a histogram of the distances.
+    """
+    K_means = cluster.MiniBatchKMeans(n_clusters=n_clusters, init=init,
+                                      n_init=3 if isinstance(init, str) else 1,
+                                      batch_size=BATCH_SIZE,
+                                      random_state=r_state)
+    # Every batch must have at least n_clusters endpoints, the endpoints
+    # left at the end of a chunk are carried over to the next one
+    batch_size = max(BATCH_SIZE, 3 * n_clusters)
+    for epoch in range(N_EPOCHS):
+        rest = np.empty((0, 2))
+        for chunk in iter_endpoints():
+            chunk = np.concatenate((rest, chunk))
+            n_full = len(chunk) - len(chunk) % batch_size
+            for start in range(0, n_full, batch_size):
+                K_means.partial_fit(chunk[start:start + batch_size])
+            rest = chunk[n_full:]
+        if len(rest) >= n_clusters:
+            K_means.partial_fit(rest)
+
+    # Histogram of the walking distances, the percentile is read from it
+    # so that the distances don't have to be kept in memory
+    n_bins = int(MAX_DIST / DIST_RESOLUTION) + 1
+    dist_counts = np.zeros(n_bins, dtype=np.int64)
+    cluster_counts = np.zeros(n_clusters, dtype=np.int64)
+    cluster_dists = np.zeros(n_clusters)
+    for chunk in iter_endpoints():
+        labels = K_means.predict(chunk)
+        dist = walking_distances(chunk[:, 0], chunk[:, 1],
+                                 K_means.cluster_centers_, labels)
+        dist_bins = np.minimum((dist / DIST_RESOLUTION).astype(np.int64),
+                               n_bins - 1)
+        dist_counts += np.bincount(dist_bins, minlength=n_bins)
+        cluster_counts += np.bincount(labels, minlength=n_clusters)
+        cluster_dists += np.bincount(labels, weights=dist,
+                                     minlength=n_clusters)
+    # First bin in which the cumulative count reaches 90%
+    cum_counts = np.cumsum(dist_counts)
+    p_bin = np.searchsorted(cum_counts, 0.9 * cum_counts[-1])
+    return (K_means, (p_bin + 0.5) * DIST_RESOLUTION, cluster_counts,
+            cluster_dists)
+
+
+def warm_start_centers(fit, n_clusters):
+    """Return n_clusters initial centroids from a fit with another number
+    of stops. Fewer stops keep the stops with the most endpoints, more stops
+    split the stops with the largest total walking distance.
+    """
+    centers, counts, dists = fit[0].cluster_centers_, fit[2], fit[3]
+    if n_clusters <= len(centers):
+        return centers[np.sort(np.argsort(-counts)[:n_clusters])]
+    # The new seeds are the split stops moved by ~10m in a random direction
+    n_new = n_clusters - len(centers)
+    split = np.resize(np.argsort(-dists), n_new)
+    offsets = r_state.normal(scale=1e-4, size=(n_new, 2))
+    return np.concatenate((centers, centers[split] + offsets))
 
-# Read the trips
-csv_data = pd.read_csv(trips_file,
-                       usecols=['pickup_datetime', 'dropoff_datetime',
-                                'pickup_longitude', 'pickup_latitude',
-                                'dropoff_longitude', 'dropoff_latitude'],
-                       parse_dates=['pickup_datetime', 'dropoff_datetime'],
-                       dtype={'pickup_longitude': np.float32,
-                              'pickup_latitude': np.float32,
-                              'dropoff_longitude': np.float32,
-                              'dropoff_latitude': np.float32})
-
-# Create new dataframe with the pickup locations
-pickup = csv_data[['pickup_longitude', 'pickup_latitude']]
-pickup.columns = ['longitude', 'latitude']
-
-# Create dataframe with dropoff locations
-dropoff = csv_data[['dropoff_longitude', 'dropoff_latitude']]
-dropoff.columns = ['longitude', 'latitude']
-
-# Combine the two dataframes(pickup and dropoff) to get a dataframe of all
-# the endpoints
-endpoints = pickup.append(dropoff).reset_index(drop=True)
 
 map_fig, map_ax = plt.subplots()
 
 # List of the bins for our hexbin
 bins = [1, 3, 8, 21, 55, 144, 233, 377, 610, 984]
 
-hb = map_ax.hexbin(endpoints['longitude'].values, endpoints['latitude'].values,
-                   gridsize=600, cmap='jet', mincnt=1, bins=bins)
+if CLUSTERING_MODE == 'minibatch':
+    # Density map built chunk by chunk on a fixed grid, first find its
+    # extent and then count the endpoints of each cell
+    min_lonlat = np.full(2, np.inf)
+    max_lonlat = np.full(2, -np.inf)
+    for chunk in iter_endpoints():
+        min_lonlat = np.minimum(min_lonlat, chunk.min(axis=0))
+        max_lonlat = np.maximum(max_lonlat, chunk.max(axis=0))
+    lon_edges = np.linspace(min_lonlat[0], max_lonlat[0], 601)
+    n_lat = max(int(600 * (max_lonlat[1] - min_lonlat[1]) /
+                    (max_lonlat[0] - min_lonlat[0])), 1)
+    lat_edges = np.linspace(min_lonlat[1], max_lonlat[1], n_lat + 1)
+    counts = np.zeros((600, n_lat), dtype=np.int64)
+    for chunk in iter_endpoints():
+        counts += np.histogram2d(chunk[:, 0], chunk[:, 1],
+                                 bins=(lon_edges, lat_edges))[0].astype(
+            np.int64)
+    # Color by bin index like the hexbin, empty cells are not drawn
+    bin_idx = np.ma.masked_less(np.searchsorted(bins, counts.T,
+                                                side='right') - 1, 0)
+    hb = map_ax.pcolormesh(lon_edges, lat_edges, bin_idx, cmap='jet',
+                           vmin=0, vmax=len(bins) - 1)
+else:
+    # Read the locations of the trips
+    csv_data = TripStore.read_trips(trips_file,
+                                    columns=['pickup_longitude',
+                                             'pickup_latitude',
+                                             'dropoff_longitude',
+                                             'dropoff_latitude'])
+
+    # Create new dataframe with the pickup locations
+    pickup = csv_data[['pickup_longitude', 'pickup_latitude']]
+    pickup.columns = ['longitude', 'latitude']
+
+    # Create dataframe with dropoff locations
+    dropoff = csv_data[['dropoff_longitude', 'dropoff_latitude']]
+    dropoff.columns = ['longitude', 'latitude']
+
+    # Combine the two dataframes(pickup and dropoff) to get a dataframe of
+    # all the endpoints
+    endpoints = pickup.append(dropoff).reset_index(drop=True)
+
+    hb = map_ax.hexbin(endpoints['longitude'].values,
+                       endpoints['latitude'].values,
+                       gridsize=600, cmap='jet', mincnt=1, bins=bins)
+
+    # Arrays of the endpoints, extracted once for all the fits. KMeans
+    # needs float64, in float32 the distances between the points are lost
+    endpoints_xy = endpoints.values.astype(np.float64)
+    endpoints_lon = endpoints_xy[:, 0]
+    endpoints_lat = endpoints_xy[:, 1]
+    endpoint_weights = None
+
+if GRID_AGGREGATION:
+    # Cluster the occupied grid cells weighted by their endpoints
+    if CLUSTERING_MODE == 'minibatch':
+        endpoints_xy, endpoint_weights = aggregate_endpoints(iter_endpoints())
+    else:
+        endpoints_xy, endpoint_weights = aggregate_endpoints([endpoints_xy])
+    endpoints_lon = endpoints_xy[:, 0]
+    endpoints_lat = endpoints_xy[:, 1]
 
 # Set the aspect of the axes to be equal so that we have no distortion
 # and the output resembles manhattan
@@ -72,47 +287,53 @@ cbar.ax.set_ylabel('Counts', rotation=270, labelpad=10)
 # Initialise our random state
 r_state = np.random.RandomState(1234)
 
+# Fitted models for each number of clusters
+fits = {}
+
+
+def fit_clusters(n_clusters):
+    """ Fit n_clusters clusters once, return the cached fit after."""
+    if n_clusters not in fits:
+        init = 'k-means++'
+        if SEARCH_MODE == 'bisect' and fits:
+            closest = min(fits, key=lambda k: abs(k - n_clusters))
+            init = warm_start_centers(fits[closest], n_clusters)
+        if CLUSTERING_MODE == 'minibatch' and not GRID_AGGREGATION:
+            fits[n_clusters] = fit_minibatch(n_clusters, init)
+        else:
+            fits[n_clusters] = fit_kmeans(n_clusters, init)
+    return fits[n_clusters]
+
+
 # Start with 40 clusters and increase by 5 until the 90th percentile
 # Manhattan distance to walk is less than 400m
 n_clusters = 40
-# Dataframe to hold the average walking distance for each n_clusters
-clusters_dist = pd.DataFrame(columns=['n_clusters', '90perc_mnh_dist'])
-clusters_df_idx = 0
-# Initialise variable to hold the output of KMeans
-centroids = None
-# Initialise variable to hold Manhattan distances from stops to endpoints
-manh_dist = np.empty(len(endpoints))
-
-while True:
-    # Fit KMeans
-    K_means = cluster.KMeans(n_clusters=n_clusters, init='k-means++', n_init=4,
-                             random_state=r_state, n_jobs=-1)
-    centroids = K_means.fit(endpoints.values)
+step = 5
 
-    # Store the Manhattan distance from the endpoints
-    # to the bus stops
-    for idx, row in endpoints.iterrows():
-        label = centroids.labels_[idx]
-        centroid = centroids.cluster_centers_[label]
-        c_lon = centroid[0]
-        c_lat = centroid[1]
-        r_lon = row['longitude']
-        r_lat = row['latitude']
-        # Calculate the distance in metres using the haversine formula
-        # https://en.wikipedia.org/wiki/Haversine_formula
-        d_lon = OSMParser.haversine(c_lon, c_lat, r_lon, c_lat)
-        d_lat = OSMParser.haversine(c_lon, c_lat, c_lon, r_lat)
-        manh_dist[idx] = d_lon + d_lat
-
-    nnth_percentile = np.percentile(manh_dist, 90)
-    clusters_dist.loc[clusters_df_idx] = [n_clusters, nnth_percentile]
+if SEARCH_MODE == 'bisect':
+    # Double the step until the distance is less than 400m, then bisect
+    # between the last two numbers of clusters in multiples of 5
+    low = None
+    while fit_clusters(n_clusters)[1] >= 400:
+        low = n_clusters
+        n_clusters += step
+        step *= 2
+    while low is not None and n_clusters - low > 5:
+        middle = low + (n_clusters - low) // 10 * 5
+        if fit_clusters(middle)[1] < 400:
+            n_clusters = middle
+        else:
+            low = middle
+else:
     # If the 90th percentile Manhattan distance is less than 400m stop,
     # otherwise increase our clusters by 5
-    if np.percentile(nnth_percentile, 90) < 400:
-        break
-    else:
-        n_clusters += 5
-        clusters_df_idx += 1
+    while fit_clusters(n_clusters)[1] >= 400:
+        n_clusters += step
+
+centroids = fits[n_clusters][0]
+# Dataframe to hold the average walking distance for each n_clusters
+clusters_dist = pd.DataFrame([[k, fits[k][1]] for k in sorted(fits)],
+                             columns=['n_clusters', '90perc_mnh_dist'])
 
 # Create labels for our clusters(bus stops) and save their locations
 cluster_labels = np.arange(n_clusters)[:, np.newaxis]
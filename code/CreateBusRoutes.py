@@ -1,13 +1,13 @@
 from pathlib import Path
+from multiprocessing import Pool
 import matplotlib
 import matplotlib.pyplot as plt
 import numpy as np
-import networkx as nx
 import pandas as pd
 from sklearn import cluster
 from scipy.spatial import distance
-from itertools import combinations
 import OSMParser
+import TourSolver
 
 # Path to local data
 local_data_folder = Path('../data/')
@@ -16,94 +16,82 @@ dataset = 'sample'
 dataset_folder = local_data_folder / dataset
 
 osm_file = local_data_folder / 'map.osm'
-# Read the OSM as a directed graph
-G = OSMParser.read_osm(str(osm_file))
-# We convert to undirected graph because a bus stop may have been placed in
-# a dead end.
-G = G.to_undirected()
-# We get the giant component because our graph has many components
-# so we may not be able to get from some point A to point B
-G = max(nx.connected_component_subgraphs(G), key=len)
+# Read the OSM as an undirected graph because a bus stop may have been
+# placed in a dead end. We get the giant component because our graph has
+# many components so we may not be able to get from some point A to point B.
+# The compiled graph is cached so only the first run parses the xml.
+graph = OSMParser.compile_osm(str(osm_file))
 
 # Read the bus stops
 bus_stops_csv = dataset_folder / 'bus_stops_relocated_with_buses.csv'
 all_stops_df = pd.read_csv(bus_stops_csv)
 # File to save the routes
 bus_routes_output_file = dataset_folder / 'bus_routes.csv'
+# Budget of the 2-opt/Or-opt improvement of each bus route, in seconds and
+# number of moves. 0 seconds keeps the nearest neighbour routes
+TSP_TIME_LIMIT = 10
+TSP_MAX_MOVES = None
+# Build the routes of the buses in parallel in a pool of N_PROCESSES
+# processes (None for one per core). The processes share the compiled
+# graph, which is memory mapped from its cache folder
+PARALLEL_ROUTES = False
+N_PROCESSES = None
+# Only build the routes of these bus_ids again, e.g. after changing their
+# stops, and keep the others of bus_routes_output_file. None builds them all
+REBUILD_BUSES = None
 
 # Get the number of buses
 n_buses = len(all_stops_df.groupby(by='bus_id'))
 
-# The final dataframe for our routes
-routes_df = pd.DataFrame(columns=['bus_id', 'route_nodes'])
 
-for bus in range(n_buses):
+def build_route(bus):
+    """ Return the dataframe of the route of bus, with its bus_id and nodes."""
     stops_df = all_stops_df[all_stops_df['bus_id'] == bus].reset_index()
-    # For all stops create 2d dataframe with shortest path lengths
-    lengths_df = pd.DataFrame(columns=stops_df['node_id'],
-                              index=stops_df['node_id'])
-    # Create the lengths dataframe
-    for start_node, end_node in combinations(stops_df['node_id'].values, 2):
-        path_length = nx.dijkstra_path_length(G, source=str(start_node),
-                                              target=str(end_node),
-                                              weight='length')
-        lengths_df.at[start_node, end_node] = path_length
-        lengths_df.at[end_node, start_node] = path_length
+    # For all stops find the shortest path lengths, with one Dijkstra
+    # from each stop over the whole graph
+    stop_positions = graph.positions(stops_df['node_id'].values)
+    lengths, predecessors = graph.distance_matrix(stop_positions)
 
-    # Run the repetitive Nearest neighbour to solve the TSP
-    min_route = None
-    min_cost = 0
-    # For every bus stop run the NN
-    for initial_bus_stop in stops_df['node_id'].values:
-        # Add all the bus stops to a list
-        bus_stops = stops_df['node_id'].values.tolist()
-        n_bus_stops = len(bus_stops)
-        # Initialise our route
-        route = [initial_bus_stop]
-        current_bus_stop = initial_bus_stop
-        # Save the unvisited stops in a list
-        unvisited_bus_stops = bus_stops
-        unvisited_bus_stops.remove(initial_bus_stop)
+    # Run the repetitive Nearest neighbour to solve the TSP and improve
+    # its route with 2-opt and Or-opt moves
+    tour, min_cost = TourSolver.solve(lengths, max_iterations=TSP_MAX_MOVES,
+                                      time_limit=TSP_TIME_LIMIT)
 
-        total_cost = 0
-        # For each stop go to the nearest neighbour
-        for i in range(n_bus_stops - 1):
-            next_bus_stop = unvisited_bus_stops[0]
-            min_distance = lengths_df.at[current_bus_stop, next_bus_stop]
-            for bus_stop in unvisited_bus_stops:
-                if lengths_df.at[current_bus_stop, bus_stop] < min_distance:
-                    next_bus_stop = bus_stop
-                    min_distance = lengths_df.at[current_bus_stop, bus_stop]
-            route.append(next_bus_stop)
-            unvisited_bus_stops.remove(next_bus_stop)
-            current_bus_stop = next_bus_stop
-            total_cost += min_distance
-
-        # Add our initial stop to close the circuit
-        route.append(initial_bus_stop)
-        total_cost += lengths_df.at[current_bus_stop, initial_bus_stop]
-        # Save the route if it is the best found so far
-        if min_route is None or total_cost < min_cost:
-            min_route = route
-            min_cost = total_cost
-
-    # Determine the shortest paths for each bus_stop in our min_route
-    # We previously just saved the cost.
-    for start_node, end_node in zip(min_route, min_route[1:]):
-        shortest_path = nx.dijkstra_path(G, source=str(start_node),
-                                         target=str(end_node),
-                                         weight='length')
-
-        shortest_path_array = np.array(shortest_path)
-        bus_id_array = np.full(len(shortest_path), bus)
-        route_part_df = pd.DataFrame({'bus_id': bus_id_array,
-                                      'route_nodes': shortest_path_array})
+    # Determine the shortest paths for each bus_stop in our route from the
+    # shortest path trees of the stops. We previously just saved the cost.
+    route_parts = []
+    for start, end in zip(tour, tour[1:]):
+        shortest_path = graph.path(predecessors[start], stop_positions[end])
         # If this is not the first intermediate route between stops
         # don't save the starting point because it's the ending point
         # of the previous route and we end up with duplicates
-        if len(routes_df[routes_df['bus_id']==bus]) != 0:
-            route_part_df = route_part_df.iloc[1:]
-        routes_df = routes_df.append(route_part_df).reset_index(drop=True)
+        if len(route_parts) != 0:
+            shortest_path = shortest_path[1:]
+        route_parts.append(shortest_path)
+
+    # Fill the nodes of the route at once
+    route_positions = np.concatenate(route_parts)
+    routes_df = pd.DataFrame({'bus_id': np.full(len(route_positions), bus),
+                              'route_nodes': graph.node_ids[route_positions]})
+    return routes_df
+
+
+# The pool re-imports this module in its processes, so the routes are only
+# built from the main one
+if __name__ == '__main__':
+    buses = range(n_buses) if REBUILD_BUSES is None else REBUILD_BUSES
+    if PARALLEL_ROUTES:
+        with Pool(N_PROCESSES) as pool:
+            bus_routes = pool.map(build_route, buses)
+    else:
+        bus_routes = [build_route(bus) for bus in buses]
+    if REBUILD_BUSES is not None:
+        kept_df = pd.read_csv(bus_routes_output_file)
+        bus_routes.append(kept_df[~kept_df['bus_id'].isin(REBUILD_BUSES)])
+
+    # The final dataframe for our routes, in bus_id order
+    routes_df = pd.concat(bus_routes, ignore_index=True)
+    routes_df = routes_df.sort_values('bus_id', kind='mergesort')
 
-# Save the buses' routes to file
-routes_df.to_csv(bus_routes_output_file, index=False)
+    # Save the buses' routes to file
+    routes_df.to_csv(bus_routes_output_file, index=False)
@@ -1,11 +1,12 @@
-from itertools import islice
 from pathlib import Path
 import matplotlib
 matplotlib.rcParams['text.usetex'] = True
 matplotlib.rcParams['font.family'] = 'serif'
 import matplotlib.pyplot as plt
 import matplotlib.colors
+import BusNetwork
 import OSMParser
+import TripStore
 import numpy as np
 import networkx as nx
 import xml.etree.ElementTree as ET
@@ -18,14 +19,12 @@ dataset = 'full'
 dataset_folder = local_data_folder / dataset
 
 osm_file = local_data_folder / 'map.osm'
-# Read the OSM as a directed graph
-G = OSMParser.read_osm(str(osm_file))
-# We convert to undirected graph because a bus stop may have been placed in
-# a dead end.
-G = G.to_undirected()
-# We get the giant component because our graph has many components
-# so we may not be able to get from some point A to point B
-G = max(nx.connected_component_subgraphs(G), key=len)
+# Read the OSM as an undirected graph because a bus stop may have been
+# placed in a dead end. We get the giant component because our graph has
+# many components so we may not be able to get from some point A to point B.
+# The compiled graph is cached so only the first run parses the xml.
+graph = OSMParser.compile_osm(str(osm_file))
+G = graph.to_networkx()
 
 # Average walking speed 1.2m/s
 # https://journals.sagepub.com/doi/pdf/10.1177/0361198106198200104
@@ -39,49 +38,27 @@ bus_routes_df = pd.read_csv(bus_routes_csv)
 # Read the bus stops
 bus_stops_csv = dataset_folder / 'bus_stops_relocated_with_buses.csv'
 bus_stops_df = pd.read_csv(bus_stops_csv)
-# Read the trips
-trips_csv = local_data_folder / 'sample_relocated_trips.csv'
-trips_df = pd.read_csv(trips_csv)
+# Read the trips. Format of the trips file, 'csv' or 'parquet'
+trips_format = 'csv'
+trips_csv = TripStore.trips_path(local_data_folder, 'sample_relocated_trips',
+                                 trips_format)
+trips_df = TripStore.read_trips(trips_csv)
 
 # File to save the csv output
 example_trip_output_file = dataset_folder / 'example_trip.csv'
 # File to save the plot
 example_trip_graph_output_file = dataset_folder / 'example_trip.eps'
-
-# The following loop adds edges between bus stops with the appropriate weights
-grouped_routes = bus_routes_df.groupby('bus_id')
-for bus_id, group in grouped_routes:
-    # The current_bus_stops are the stops of the bus_id but unordered
-    current_bus_stops = bus_stops_df.loc[bus_stops_df['bus_id'] == bus_id]
-    current_bus_stops_nodes = list(map(str, current_bus_stops['node_id']))
-    # Save the starting stop
-    initial_bus_stop_node = str(group.iloc[0]['route_nodes'])
-
-    # Create a list of all the unvisited stops so far
-    unvisited_bus_stops = current_bus_stops_nodes
-    unvisited_bus_stops.remove(initial_bus_stop_node)
-
-    # Calculate the length and duration between 2 bus stops
-    # and add an edge between those 2 nodes in our graph G
-    length_btw_stops = 0
-    previous_bus_stop = initial_bus_stop_node
-    previous_node = initial_bus_stop_node
-    # Iterate over all the nodes in the route but not the first
-    for idx, row in islice(group.iterrows(), 1, None):
-        current_node = str(row['route_nodes'])
-        length_btw_stops += G.edge[previous_node][current_node]['length']
-        if current_node in unvisited_bus_stops:
-            # Average Manhattan bus speed 2.5m/s
-            duration = length_btw_stops / 2.5
-            G.add_edge(previous_bus_stop, current_node,
-                       {'length': length_btw_stops, 'duration': duration,
-                        'bus_id': bus_id})
-            length_btw_stops = 0
-            unvisited_bus_stops.remove(current_node)
-            if len(unvisited_bus_stops) == 0:
-                unvisited_bus_stops.append(initial_bus_stop_node)
-            previous_bus_stop = current_node
-        previous_node = current_node
+# Search for the trip, 'dijkstra', 'astar' or 'bidirectional' (see
+# BusNetwork.py). The number of settled nodes is printed to compare them.
+ROUTING = 'dijkstra'
+# Folder of the cached bus edges
+bus_edges_folder = dataset_folder / 'bus_edges_cache'
+
+# Add edges between bus stops with the appropriate weights, the edges are
+# built once for the routes and stops and then loaded from bus_edges_folder
+bus_edges = BusNetwork.bus_overlay(graph, bus_routes_csv, bus_stops_csv,
+                                   bus_edges_folder)
+BusNetwork.add_bus_edges(G, graph, bus_edges)
 # Now our graph G has edges from one bus stop to the other with the
 # related length and duration as attributes
 
@@ -95,34 +72,14 @@ row = row.reset_index(drop=True).iloc[0]
 # Calculate trip distance
 pickup_node = str(row['pickup_node'])
 dropoff_node = str(row['dropoff_node'])
-path = nx.dijkstra_path(G, source=pickup_node,
-                             target=dropoff_node,
-                             weight='duration')
-total_duration = 0
-walking_distance = 0
-bus_ride_distance = 0
-buses_used = 0
-unique_buses = []
-# Save previous method of transportation
-walking_flag = True
-for u, v in zip(path, path[1:]):
-    edge_data = G.get_edge_data(u, v)
-    total_duration += edge_data['duration']
-    if 'bus_id' in edge_data:
-        bus_ride_distance += edge_data['length']
-    else:
-        walking_distance += edge_data['length']
-    if 'bus_id' in edge_data and walking_flag:
-        buses_used += 1
-        walking_flag = False
-        bus_id = edge_data['bus_id']
-        if not(bus_id in unique_buses):
-            unique_buses.append(bus_id)
-    if not('bus_id' in edge_data) and not(walking_flag):
-        walking_flag = True
+path, settled_nodes = BusNetwork.ROUTINGS[ROUTING](G, pickup_node,
+                                                    dropoff_node)
+print('Settled nodes with ' + ROUTING + ': ' + str(settled_nodes))
+(total_duration, buses_used, unique_buses, bus_ride_distance,
+ walking_distance) = BusNetwork.path_statistics(G, path)
 row['bus_duration'] = total_duration
 row['buses'] = buses_used
-row['unique_buses'] = len(unique_buses)
+row['unique_buses'] = unique_buses
 row['bus_ride_distance'] = bus_ride_distance
 row['walking_distance'] = walking_distance
 
@@ -30,14 +30,11 @@ bounds = root.find('bounds').attrib
 # Convert each coordinate str value in bounds to float
 for k, v in bounds.items():
     bounds[k] = float(v)
-# Read the OSM as a directed graph
-G = OSMParser.read_osm(str(osm_file))
-# We convert to undirected graph because a bus stop may have been placed in
-# a dead end.
-G = G.to_undirected()
-# We get the giant component because our graph has many components
-# so we may not be able to get from some point A to point B
-G = max(nx.connected_component_subgraphs(G), key=len)
+# Read the OSM as an undirected graph because a bus stop may have been
+# placed in a dead end. We get the giant component because our graph has
+# many components so we may not be able to get from some point A to point B.
+# The compiled graph is cached so only the first run parses the xml.
+G = OSMParser.read_osm(str(osm_file), giant_component=True, cache=True)
 
 # Read the bus stops
 bus_stops_csv = dataset_folder / 'bus_stops_relocated_with_buses.csv'
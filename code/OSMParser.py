@@ -8,6 +8,8 @@ Added :
 - : Python3.6 compatibility
 - : Cache for avoiding to download again the same osm tiles
 - : distance computation to estimate length of each ways (useful to compute the shortest path)
+- : Compiled road graph (CSR arrays of the giant component) cached on disk
+- : Low memory streaming parser keeping only the road nodes in numpy arrays
 
 Copyright (C) 2017 Loïc Messal (github : Tofull)
 
@@ -15,14 +17,26 @@ Copyright (C) 2017 Loïc Messal (github : Tofull)
 
 ## Modules
 # Elementary modules
-from math import radians, cos, sin, asin, sqrt
+from array import array
 import copy
+import hashlib
+import os
+import pickle
+import shutil
+import tempfile
+
+# Array modules
+import numpy as np
+from scipy import sparse
+from scipy.sparse import csgraph
+from scipy.spatial import cKDTree
 
 # Graph module
 import networkx
 
 # Specific modules
 import xml.sax # parse osm file
+import xml.etree.ElementTree as ET # stream osm file in low memory mode
 from pathlib import Path # manage cached tiles
 
 
@@ -31,22 +45,36 @@ def haversine(lon1, lat1, lon2, lat2, unit_m = True):
     """
     Calculate the great circle distance between two points
     on the earth (specified in decimal degrees)
+    The coordinates can be scalars or numpy arrays, in which case the
+    distances of all the pairs are computed at once
     default unit : m
     """
     # convert decimal degrees to radians
-    lon1, lat1, lon2, lat2 = map(radians, [lon1, lat1, lon2, lat2])
+    lon1, lat1, lon2, lat2 = (np.radians(np.asarray(x, dtype=np.float64)) for x in (lon1, lat1, lon2, lat2))
 
     # haversine formula
     dlon = lon2 - lon1
     dlat = lat2 - lat1
-    a = sin(dlat/2)**2 + cos(lat1) * cos(lat2) * sin(dlon/2)**2
-    c = 2 * asin(sqrt(a))
+    a = np.sin(dlat/2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon/2)**2
+    c = 2 * np.arcsin(np.sqrt(a))
     r = 6371 # Radius of earth in kilometers. Use 3956 for miles
     if (unit_m):
         r *= 1000
     return c * r
 
 
+def manhattan_distance(lon1, lat1, lon2, lat2, unit_m = True):
+    """
+    Calculate the Manhattan distance between two points, the sum of the
+    haversine distances along the longitude and along the latitude
+    Accepts scalars or numpy arrays like haversine
+    default unit : m
+    """
+    d_lon = haversine(lon1, lat1, lon2, lat1, unit_m = unit_m)
+    d_lat = haversine(lon1, lat1, lon1, lat2, unit_m = unit_m)
+    return d_lon + d_lat
+
+
 
 def download_osm(left, bottom, right, top, proxy = False, proxyHost = "10.0.4.2", proxyPort = "3128", cache = False, cacheTempDir = "/tmp/tmpOSM/", verbose = True):
     """ Return a filehandle to the downloaded data from osm api."""
@@ -110,11 +138,18 @@ def download_osm(left, bottom, right, top, proxy = False, proxyHost = "10.0.4.2"
     return fp
 
 
-def read_osm(filename_or_stream, only_roads=True):
+def read_osm(filename_or_stream, only_roads=True, giant_component=False, cache=False, cacheDir=None, low_memory=False):
     """Read graph in OSM format from file specified by name or by stream object.
     Parameters
     ----------
     filename_or_stream : filename or stream object
+    giant_component : if True return the undirected giant component of the
+        graph instead of the full directed graph
+    cache : if True (and giant_component is True) load the compiled road
+        graph from the cache folder, compiling it on the first run
+    cacheDir : cache folder, see compile_osm
+    low_memory : if True parse the file with CompactOSM, which needs a
+        filename or a seekable stream
 
     Returns
     -------
@@ -127,6 +162,27 @@ def read_osm(filename_or_stream, only_roads=True):
     >>> plt.plot([G.node[n]['lat']for n in G], [G.node[n]['lon'] for n in G], 'o', color='k')
     >>> plt.show()
     """
+    if (giant_component):
+        if (cache):
+            return compile_osm(filename_or_stream, only_roads=only_roads, cacheDir=cacheDir).to_networkx()
+        if (low_memory):
+            return RoadGraph.from_compact(CompactOSM(filename_or_stream, only_roads=only_roads)).to_networkx()
+        return RoadGraph.from_digraph(read_osm(filename_or_stream, only_roads=only_roads)).to_networkx()
+
+    if (low_memory):
+        osm = CompactOSM(filename_or_stream, only_roads=only_roads)
+        u, v, seg = osm.edges()
+        used = np.unique(np.concatenate((u, v)))
+        ids = osm.node_ids.astype(str).tolist()
+        seg_ids = osm.segment_ids()
+        G = networkx.DiGraph()
+        G.add_nodes_from((ids[i], {'lat': lat, 'lon': lon, 'id': ids[i]})
+                         for i, lon, lat in zip(used.tolist(), osm.lon[used].tolist(), osm.lat[used].tolist()))
+        distances = haversine(osm.lon[u], osm.lat[u], osm.lon[v], osm.lat[v], unit_m = True)
+        G.add_edges_from((ids[a], ids[b], {'id': seg_ids[s], 'length': distance})
+                         for a, b, s, distance in zip(u.tolist(), v.tolist(), seg.tolist(), distances.tolist()))
+        return G
+
     osm = OSM(filename_or_stream)
     G = networkx.DiGraph()
 
@@ -155,15 +211,393 @@ def read_osm(filename_or_stream, only_roads=True):
         G.node[n_id]['lon'] = n.lon
         G.node[n_id]['id'] = n.id
 
-    ## Estimate the length of each way
-    for u,v,d in G.edges_iter(data=True):
-        distance = haversine(G.node[u]['lon'], G.node[u]['lat'], G.node[v]['lon'], G.node[v]['lat'], unit_m = True) # Give a realistic distance estimation (neither EPSG nor projection nor reference system are specified)
+    ## Estimate the length of each way, for all the edges at once
+    edges = list(G.edges_iter())
+    lon = np.array([[G.node[u]['lon'], G.node[v]['lon']] for u, v in edges]).reshape(-1, 2)
+    lat = np.array([[G.node[u]['lat'], G.node[v]['lat']] for u, v in edges]).reshape(-1, 2)
+    distances = haversine(lon[:, 0], lat[:, 0], lon[:, 1], lat[:, 1], unit_m = True) # Give a realistic distance estimation (neither EPSG nor projection nor reference system are specified)
 
-        G.add_weighted_edges_from([( u, v, distance)], weight='length')
+    G.add_weighted_edges_from(((u, v, distance) for (u, v), distance in zip(edges, distances.tolist())), weight='length')
 
     return G
 
 
+# Bump when the layout of the compiled graph changes so old caches are ignored
+COMPILED_GRAPH_VERSION = 1
+
+
+def osm_file_hash(filename, only_roads=True):
+    """ Return the hex digest identifying a compiled graph of the osm file."""
+    h = hashlib.sha1()
+    h.update(("v%d;only_roads=%d;" % (COMPILED_GRAPH_VERSION, only_roads)).encode())
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def compile_osm(filename, only_roads=True, cacheDir=None, verbose=True):
+    """Return the RoadGraph of the osm file, compiling it only once.
+
+    The compiled graph is saved in cacheDir (default : an osm_cache folder
+    next to the osm file) under the hash of the osm file, later calls
+    memory map the saved arrays instead of parsing the xml again.
+    """
+    filename = str(filename)
+    if cacheDir is None:
+        cacheDir = os.path.join(os.path.dirname(os.path.abspath(filename)), 'osm_cache')
+    graph_dir = os.path.join(str(cacheDir), osm_file_hash(filename, only_roads))
+
+    if os.path.isdir(graph_dir):
+        if (verbose):
+            print("Compiled graph loaded from the cache folder.")
+        return RoadGraph.load(graph_dir)
+
+    if (verbose):
+        print("Compile the road graph of", filename)
+    graph = RoadGraph.from_compact(CompactOSM(filename, only_roads=only_roads))
+
+    # Write in a temporary folder first so that an interrupted run never
+    # leaves a half written graph behind
+    os.makedirs(str(cacheDir), exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=str(cacheDir))
+    graph.save(tmp_dir)
+    try:
+        os.rename(tmp_dir, graph_dir)
+    except OSError:
+        # Another process compiled the same graph in the meantime
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    return RoadGraph.load(graph_dir)
+
+
+class RoadGraph:
+    """Undirected road graph stored as flat arrays.
+
+    Nodes are referred to by their position, sorted by osm id. The
+    adjacency is in CSR form : the neighbours of the node at position i are
+    indices[indptr[i]:indptr[i+1]] and length holds the length (m) of each
+    of those edges. Every edge is stored in both directions.
+
+    A graph loaded from a folder also caches its spatial indexes there.
+    """
+    ARRAYS = ('node_ids', 'lon', 'lat', 'indptr', 'indices', 'length')
+
+    def __init__(self, node_ids, lon, lat, indptr, indices, length, folder=None):
+        self.node_ids = node_ids
+        self.lon = lon
+        self.lat = lat
+        self.indptr = indptr
+        self.indices = indices
+        self.length = length
+        self.folder = folder
+        self._kdtree = None
+
+    def __len__(self):
+        return len(self.node_ids)
+
+    @classmethod
+    def from_edges(cls, node_ids, lon, lat, u, v, length, giant_component=True):
+        """ Build the graph from (possibly directed, duplicated) edges between node positions."""
+        n = len(node_ids)
+        # Keep each undirected edge once
+        a = np.minimum(u, v)
+        b = np.maximum(u, v)
+        keep = a != b
+        a, b, length = a[keep], b[keep], length[keep]
+        _, first = np.unique(a.astype(np.int64) * n + b, return_index=True)
+        a, b, length = a[first], b[first], length[first]
+
+        if (giant_component):
+            adjacency = sparse.coo_matrix((np.ones(len(a)), (a, b)), shape=(n, n))
+            _, labels = csgraph.connected_components(adjacency, directed=False)
+            giant = labels == np.argmax(np.bincount(labels))
+            # Renumber the nodes of the giant component
+            new_position = np.cumsum(giant) - 1
+            keep = giant[a]
+            a, b, length = new_position[a[keep]], new_position[b[keep]], length[keep]
+            node_ids, lon, lat = node_ids[giant], lon[giant], lat[giant]
+            n = len(node_ids)
+
+        # Both directions, sorted by source to get the CSR layout
+        src = np.concatenate((a, b))
+        dst = np.concatenate((b, a))
+        length = np.concatenate((length, length))
+        order = np.lexsort((dst, src))
+        indptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(src, minlength=n), out=indptr[1:])
+        return cls(node_ids, lon, lat, indptr,
+                   dst[order].astype(np.int32), length[order].astype(np.float64))
+
+    @classmethod
+    def from_digraph(cls, G, giant_component=True):
+        """ Build the graph from the directed graph returned by read_osm."""
+        ids = sorted(G.nodes(), key=int)
+        node_ids = np.array(ids, dtype=np.int64)
+        position = dict(zip(ids, range(len(ids))))
+        lon = np.empty(len(ids))
+        lat = np.empty(len(ids))
+        for n_id, d in G.nodes(data=True):
+            lon[position[n_id]] = d['lon']
+            lat[position[n_id]] = d['lat']
+        n_edges = G.number_of_edges()
+        u = np.empty(n_edges, dtype=np.int64)
+        v = np.empty(n_edges, dtype=np.int64)
+        length = np.empty(n_edges)
+        for i, (a, b, d) in enumerate(G.edges(data=True)):
+            u[i] = position[a]
+            v[i] = position[b]
+            length[i] = d['length']
+        return cls.from_edges(node_ids, lon, lat, u, v, length, giant_component=giant_component)
+
+    @classmethod
+    def from_compact(cls, osm, giant_component=True):
+        """ Build the graph from a CompactOSM, without going through networkx."""
+        u, v, _ = osm.edges()
+        length = haversine(osm.lon[u], osm.lat[u], osm.lon[v], osm.lat[v], unit_m = True)
+        return cls.from_edges(osm.node_ids, osm.lon, osm.lat, u, v, length, giant_component=giant_component)
+
+    def save(self, folder):
+        for name in self.ARRAYS:
+            np.save(os.path.join(folder, name + '.npy'), getattr(self, name))
+
+    @classmethod
+    def load(cls, folder, mmap_mode='r'):
+        return cls(*(np.load(os.path.join(folder, name + '.npy'), mmap_mode=mmap_mode)
+                     for name in cls.ARRAYS), folder=folder)
+
+    def _cached(self, filename, build):
+        """ Return the object pickled in filename of the graph folder, building it if needed."""
+        if self.folder is None:
+            return build()
+        path = os.path.join(self.folder, filename)
+        if os.path.isfile(path):
+            with open(path, 'rb') as f:
+                return pickle.load(f)
+        obj = build()
+        fd, tmp_path = tempfile.mkstemp(dir=self.folder)
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+        return obj
+
+    def kdtree(self):
+        """ Return the KD-tree of the (lon, lat) of the nodes."""
+        if self._kdtree is None:
+            self._kdtree = self._cached('kdtree.pickle', lambda: cKDTree(
+                np.column_stack((self.lon, self.lat))))
+        return self._kdtree
+
+    def nearest_positions(self, lon, lat):
+        """Return the positions of the closest nodes to the points (lon, lat), arrays or scalars.
+
+        The distance is the euclidean in degrees, which is good enough to find
+        the closest node in a city sized map.
+        """
+        points = np.column_stack((np.ravel(lon), np.ravel(lat))).astype(np.float64)
+        _, pos = self.kdtree().query(points)
+        return pos.reshape(np.shape(lon))
+
+    def segment_index(self, cell_size=100):
+        """ Return the SegmentIndex of the edges, cell_size in m."""
+        return self._cached('segments.%d.pickle' % cell_size,
+                            lambda: SegmentIndex(self, cell_size))
+
+    def positions(self, node_ids):
+        """ Return the positions of the given osm ids (int or str)."""
+        node_ids = np.asarray(node_ids).astype(np.int64)
+        pos = np.minimum(np.searchsorted(self.node_ids, node_ids), len(self.node_ids) - 1)
+        if np.any(self.node_ids[pos] != node_ids):
+            raise KeyError("Node not in the road graph")
+        return pos
+
+    def edges(self):
+        """ Return the (u, v, length) arrays of every edge once, with u < v."""
+        src = np.repeat(np.arange(len(self.node_ids)), np.diff(self.indptr))
+        once = src < self.indices
+        return src[once], np.asarray(self.indices)[once], np.asarray(self.length)[once]
+
+    def edge_lengths(self, u, v):
+        """ Return the lengths of the edges between the positions u and v."""
+        n = len(self.node_ids)
+        edge_keys = np.repeat(np.arange(n), np.diff(self.indptr)) * n + self.indices
+        keys = np.asarray(u, dtype=np.int64) * n + v
+        e = np.minimum(np.searchsorted(edge_keys, keys), len(edge_keys) - 1)
+        if np.any(edge_keys[e] != keys):
+            raise KeyError("Edge not in the road graph")
+        return np.asarray(self.length)[e]
+
+    def to_csr(self, weight=None):
+        """ Return the adjacency as a scipy csr_matrix weighted by length or by the given edge array."""
+        data = self.length if weight is None else weight
+        n = len(self.node_ids)
+        return sparse.csr_matrix((data, self.indices, self.indptr), shape=(n, n))
+
+    def distance_matrix(self, positions, weight=None):
+        """Run a single Dijkstra from each of the node positions.
+
+        Returns the (k, k) matrix of the shortest path lengths between the
+        positions and the (k, n) predecessors of every node on the shortest
+        paths from each position, -9999 at the sources and unreachable nodes.
+        """
+        positions = np.asarray(positions)
+        dist, predecessors = csgraph.dijkstra(self.to_csr(weight), indices=positions,
+                                              return_predecessors=True)
+        return dist[:, positions], predecessors
+
+    @staticmethod
+    def path(predecessors, target):
+        """Return the positions of the nodes on the shortest path to target.
+
+        predecessors is the row of the source in the predecessors returned by
+        distance_matrix, the path starts from that source.
+        """
+        path = [target]
+        while predecessors[path[-1]] >= 0:
+            path.append(predecessors[path[-1]])
+        return path[::-1]
+
+    def to_networkx(self):
+        """ Return the graph as networkx Graph, in the format used by read_osm."""
+        G = networkx.Graph()
+        ids = self.node_ids.astype(str).tolist()
+        G.add_nodes_from((n_id, {'lon': lon, 'lat': lat, 'id': n_id})
+                         for n_id, lon, lat in zip(ids, self.lon.tolist(), self.lat.tolist()))
+        u, v, length = self.edges()
+        G.add_edges_from((ids[a], ids[b], {'length': l})
+                         for a, b, l in zip(u.tolist(), v.tolist(), length.tolist()))
+        return G
+
+
+class SegmentIndex:
+    """Grid index over the edges (road segments) of a RoadGraph.
+
+    The coordinates are projected to metres around the mean latitude of the
+    map (equirectangular) and every segment is registered in the grid cells
+    covered by its bounding box. A query searches the cells in rings of
+    growing size around each point until no unseen cell can hold a closer
+    segment, so the result is exact whatever the length of the segments.
+    """
+    def __init__(self, graph, cell_size=100):
+        self.cell_size = float(cell_size)
+        self.u, self.v, self.length = graph.edges()
+        self.lat0 = float(np.mean(graph.lat))
+        x, y = self.project(graph.lon, graph.lat)
+        self.ax, self.ay = x[self.u], y[self.u]
+        self.bx, self.by = x[self.v], y[self.v]
+        self.x0, self.y0 = float(np.min(x)), float(np.min(y))
+        self.n_cols = int((np.max(x) - self.x0) // self.cell_size) + 1
+        self.n_rows = int((np.max(y) - self.y0) // self.cell_size) + 1
+
+        # Cells covered by the bounding box of every segment
+        col0, row0 = self._cell(np.minimum(self.ax, self.bx), np.minimum(self.ay, self.by))
+        col1, row1 = self._cell(np.maximum(self.ax, self.bx), np.maximum(self.ay, self.by))
+        n_cols = col1 - col0 + 1
+        n_cells = n_cols * (row1 - row0 + 1)
+        seg = np.repeat(np.arange(len(self.u)), n_cells)
+        k = np.arange(len(seg)) - np.repeat(np.cumsum(n_cells) - n_cells, n_cells)
+        cells = (col0[seg] + k % n_cols[seg]) * self.n_rows + row0[seg] + k // n_cols[seg]
+
+        # CSR from the occupied cells to their segments
+        order = np.argsort(cells, kind='mergesort')
+        self.cell_segments = seg[order]
+        self.cells, first = np.unique(cells[order], return_index=True)
+        self.cell_ptr = np.append(first, len(order))
+
+    def project(self, lon, lat):
+        """ Return the (x, y) in m of lon, lat."""
+        r = 6371000 * np.pi / 180
+        return (np.asarray(lon, dtype=np.float64) * r * np.cos(np.radians(self.lat0)),
+                np.asarray(lat, dtype=np.float64) * r)
+
+    def _cell(self, x, y):
+        col = np.clip(((x - self.x0) // self.cell_size).astype(np.int64), 0, self.n_cols - 1)
+        row = np.clip(((y - self.y0) // self.cell_size).astype(np.int64), 0, self.n_rows - 1)
+        return col, row
+
+    def _distances(self, px, py, seg):
+        """ Return the distance to seg of the points and the position t (0 to 1) of the projection."""
+        dx = self.bx[seg] - self.ax[seg]
+        dy = self.by[seg] - self.ay[seg]
+        d2 = dx * dx + dy * dy
+        t = ((px - self.ax[seg]) * dx + (py - self.ay[seg]) * dy) / np.where(d2 > 0, d2, 1)
+        t = np.clip(t, 0, 1)
+        return np.hypot(px - self.ax[seg] - t * dx, py - self.ay[seg] - t * dy), t
+
+    def nearest_segments(self, lon, lat):
+        """Project the points (lon, lat arrays) onto their nearest segment.
+
+        Returns the arrays
+        - u, v : graph positions of the ends of the segment
+        - offset : distance (m) along the segment from u to the projection
+        - distance : distance (m) from the point to the projection
+        """
+        seg, t, distance = self._nearest(np.ravel(lon), np.ravel(lat))
+        shape = np.shape(lon)
+        return (self.u[seg].reshape(shape), self.v[seg].reshape(shape),
+                (t * self.length[seg]).reshape(shape), distance.reshape(shape))
+
+    def _nearest(self, lon, lat):
+        """ Return the nearest segment of the points, the position t of the projection and the distance."""
+        px, py = self.project(lon, lat)
+        n = len(px)
+        best = np.full(n, np.inf)
+        best_seg = np.zeros(n, dtype=np.int64)
+        best_t = np.zeros(n)
+        # Cell of each point, points outside the grid use the closest border
+        # cell and are at least outside m away from any other cell
+        col, row = self._cell(px, py)
+        outside = np.maximum(0, np.minimum(
+            np.maximum(self.x0 - px, px - self.x0 - self.n_cols * self.cell_size),
+            np.maximum(self.y0 - py, py - self.y0 - self.n_rows * self.cell_size)))
+        active = np.arange(n)
+        ring = 0
+        while len(active):
+            # Cells at Chebyshev distance ring of the cell of each point
+            if ring == 0:
+                d_col = d_row = np.zeros(1, dtype=np.int64)
+            else:
+                side = np.arange(-ring, ring + 1)
+                d_col = np.concatenate((side, side, np.full(2 * ring - 1, -ring), np.full(2 * ring - 1, ring)))
+                d_row = np.concatenate((np.full(2 * ring + 1, -ring), np.full(2 * ring + 1, ring), side[1:-1], side[1:-1]))
+            c = col[active][:, None] + d_col[None, :]
+            r = row[active][:, None] + d_row[None, :]
+            inside = (c >= 0) & (c < self.n_cols) & (r >= 0) & (r < self.n_rows)
+            point = np.broadcast_to(active[:, None], c.shape)[inside]
+            key = c[inside] * self.n_rows + r[inside]
+            idx = np.searchsorted(self.cells, key)
+            found = (idx < len(self.cells)) & (self.cells[np.minimum(idx, len(self.cells) - 1)] == key)
+            point, idx = point[found], idx[found]
+            counts = self.cell_ptr[idx + 1] - self.cell_ptr[idx]
+            if counts.sum():
+                point = np.repeat(point, counts)
+                seg = self.cell_segments[np.repeat(self.cell_ptr[idx], counts) +
+                                         np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)]
+                dist, t = self._distances(px[point], py[point], seg)
+                # Keep the closest candidate of every point
+                order = np.lexsort((dist, point))
+                point, seg, dist, t = point[order], seg[order], dist[order], t[order]
+                first = np.r_[True, point[1:] != point[:-1]]
+                point, seg, dist, t = point[first], seg[first], dist[first], t[first]
+                better = dist < best[point]
+                best[point[better]] = dist[better]
+                best_seg[point[better]] = seg[better]
+                best_t[point[better]] = t[better]
+            # Any segment in the next rings is at least ring cells away
+            done = best[active] <= outside[active] + ring * self.cell_size
+            ring += 1
+            if ring > max(self.n_cols, self.n_rows):
+                break
+            active = active[~done]
+
+        return best_seg, best_t, best
+
+    def nearest_ends(self, lon, lat):
+        """ Return the graph position of the end of the nearest segment which is closest to each point along it."""
+        seg, t, _ = self._nearest(np.ravel(lon), np.ravel(lat))
+        return np.where(t <= 0.5, self.u[seg], self.v[seg]).reshape(np.shape(lon))
+
+
 class Node:
     def __init__(self, id, lon, lat):
         self.id = id
@@ -275,3 +709,132 @@ class OSM:
             for split_way in split_ways:
                 new_ways[split_way.id] = split_way
         self.ways = new_ways
+
+
+class CompactOSM:
+    """Low memory parse of the ways of an osm file.
+
+    Unlike OSM, no object is kept per node or way. The file (name or
+    seekable stream) is streamed twice : the first pass keeps the node refs
+    of the wanted ways, the second pass keeps the coordinates of only those
+    nodes. Everything is stored in numpy arrays :
+    - node_ids, lon, lat : the used nodes, sorted by id
+    - way_ids, way_oneway : osm id and oneway flag of each kept way
+    - seg_ptr, seg_nodes, seg_way : the ways split at intersections, the
+      node positions of segment i are seg_nodes[seg_ptr[i]:seg_ptr[i+1]] and
+      seg_way[i] is the index of the way it comes from
+    """
+    # Number of nodes read before they are filtered in one go
+    NODE_BATCH = 1 << 20
+
+    def __init__(self, filename_or_stream, only_roads=True):
+        way_ids = array('q')
+        way_oneway = array('b')
+        way_ptr = array('q', [0])
+        way_refs = array('q')
+
+        ## First pass : ways
+        for elem in self._iterparse(filename_or_stream, 'way'):
+            refs = [nd.get('ref') for nd in elem.iter('nd')]
+            tags = {tag.get('k'): tag.get('v') for tag in elem.iter('tag')}
+            if len(refs) < 2 or (only_roads and 'highway' not in tags):
+                continue
+            way_ids.append(int(elem.get('id')))
+            way_oneway.append(tags.get('oneway') == 'yes')
+            way_refs.extend(map(int, refs))
+            way_ptr.append(len(way_refs))
+
+        way_refs = np.frombuffer(way_refs, dtype=np.int64)
+        way_ptr = np.frombuffer(way_ptr, dtype=np.int64)
+        self.way_ids = np.frombuffer(way_ids, dtype=np.int64)
+        self.way_oneway = np.frombuffer(way_oneway, dtype=np.int8).astype(bool)
+        needed = np.unique(way_refs)
+
+        ## Second pass : coordinates of the needed nodes, filtered in batches
+        if hasattr(filename_or_stream, 'seek'):
+            filename_or_stream.seek(0)
+        found_ids, found_lon, found_lat = [], [], []
+        ids, lons, lats = array('q'), array('d'), array('d')
+
+        def keep_batch():
+            batch_ids = np.frombuffer(ids, dtype=np.int64)
+            mask = np.isin(batch_ids, needed, assume_unique=True)
+            found_ids.append(batch_ids[mask])
+            found_lon.append(np.frombuffer(lons, dtype=np.float64)[mask])
+            found_lat.append(np.frombuffer(lats, dtype=np.float64)[mask])
+
+        for elem in self._iterparse(filename_or_stream, 'node'):
+            ids.append(int(elem.get('id')))
+            lons.append(float(elem.get('lon')))
+            lats.append(float(elem.get('lat')))
+            if len(ids) == self.NODE_BATCH:
+                keep_batch()
+                ids, lons, lats = array('q'), array('d'), array('d')
+        keep_batch()
+
+        node_ids = np.concatenate(found_ids)
+        order = np.argsort(node_ids)
+        self.node_ids = node_ids[order]
+        self.lon = np.concatenate(found_lon)[order]
+        self.lat = np.concatenate(found_lat)[order]
+
+        ## Node positions of the way refs, -1 for refs missing from the file
+        pos = np.minimum(np.searchsorted(self.node_ids, way_refs), max(len(self.node_ids) - 1, 0))
+        way_nodes = np.where(self.node_ids[pos] == way_refs, pos, -1) if len(self.node_ids) else np.full(len(way_refs), -1)
+
+        self._split(way_ptr, way_nodes)
+
+    @staticmethod
+    def _iterparse(filename_or_stream, tag):
+        """ Yield the complete elements with the given tag, freeing them afterwards."""
+        context = ET.iterparse(filename_or_stream, events=('start', 'end'))
+        _, root = next(context)
+        for event, elem in context:
+            if event == 'end' and elem.tag == tag:
+                yield elem
+            if event == 'end' and elem.tag in ('node', 'way', 'relation'):
+                root.clear()
+
+    def _split(self, way_ptr, way_nodes):
+        """ Split the ways at the nodes used more than once, in one pass."""
+        n_ways = len(way_ptr) - 1
+        way_of = np.repeat(np.arange(n_ways), np.diff(way_ptr))
+        # Nodes used more than once are intersections
+        valid = way_nodes >= 0
+        count = np.bincount(way_nodes[valid], minlength=len(self.node_ids))
+        interior = np.ones(len(way_nodes), dtype=bool)
+        interior[way_ptr[:-1]] = False
+        interior[way_ptr[1:] - 1] = False
+        split = interior & valid & (count[np.maximum(way_nodes, 0)] > 1)
+
+        # An intersection ends a segment and starts the next one, so it is
+        # written twice
+        repeat = np.where(split, 2, 1)
+        self.seg_nodes = np.repeat(way_nodes, repeat)
+        self.seg_way = np.repeat(way_of, repeat)
+        new_index = np.cumsum(repeat) - repeat
+        starts = np.concatenate((new_index[way_ptr[:-1]], new_index[split] + 1))
+        starts.sort()
+        self.seg_ptr = np.append(starts, len(self.seg_nodes))
+        self.seg_way = self.seg_way[starts]
+
+    def edges(self):
+        """ Return the directed edges (u, v, segment) between node positions."""
+        seg_of = np.repeat(np.arange(len(self.seg_ptr) - 1), np.diff(self.seg_ptr))
+        same_seg = seg_of[:-1] == seg_of[1:]
+        u = self.seg_nodes[:-1][same_seg]
+        v = self.seg_nodes[1:][same_seg]
+        seg = seg_of[:-1][same_seg]
+        # Drop the edges of nodes missing from the file
+        keep = (u >= 0) & (v >= 0)
+        u, v, seg = u[keep], v[keep], seg[keep]
+        both = ~self.way_oneway[self.seg_way[seg]]
+        return (np.concatenate((u, v[both])),
+                np.concatenate((v, u[both])),
+                np.concatenate((seg, seg[both])))
+
+    def segment_ids(self):
+        """ Return the id of each segment, like the ids of the split ways of OSM."""
+        first = np.searchsorted(self.seg_way, self.seg_way)
+        number = np.arange(len(self.seg_way)) - first
+        return ["%d-%d" % (self.way_ids[w], i) for w, i in zip(self.seg_way.tolist(), number.tolist())]
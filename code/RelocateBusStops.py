@@ -2,9 +2,7 @@ from pathlib import Path
 import matplotlib
 import matplotlib.pyplot as plt
 import numpy as np
-import networkx as nx
 import pandas as pd
-from scipy.spatial import distance
 import OSMParser
 
 matplotlib.rcParams['text.usetex'] = True
@@ -21,24 +19,15 @@ dataset_folder = local_data_folder / dataset
 bus_stops_file = dataset_folder / 'bus_stops.csv'
 # Relocated bus stops file
 bus_stops_relocated_output = dataset_folder / 'bus_stops_relocated.csv'
+# Boolean to define if we want to snap the stops to the nearest road
+# segment and take its closest end along the segment, instead of taking
+# the nearest node which may be on a parallel street
+SNAP_TO_EDGES = False
 
-# Read the OSM as a directed graph
-G = OSMParser.read_osm(str(osm_file))
-# We convert to undirected graph because a bus stop may have been placed in
-# a dead end.
-G = G.to_undirected()
-# We get the giant component because our graph has many components
-# so we may not be able to get from some point A to point B
-G = max(nx.connected_component_subgraphs(G), key=len)
-
-# Create a dictionary(pos) which has the node id as keys and
-# values equal to (lon, lat) of the node
-lons = nx.get_node_attributes(G, 'lon')
-lats = nx.get_node_attributes(G, 'lat')
-ds = [lons, lats]
-pos = {}
-for k, v in lons.items():
-    pos[k] = tuple(pos[k] for pos in ds)
+# Read the compiled OSM graph, its nodes are the giant component of the
+# undirected road graph since a bus stop may have been placed in a dead end.
+# The compiled graph and its nearest node index are cached.
+graph = OSMParser.compile_osm(str(osm_file))
 
 # Read the bus stops
 bus_stops_df = pd.read_csv(bus_stops_file,
@@ -46,22 +35,19 @@ bus_stops_df = pd.read_csv(bus_stops_file,
                                   'longitude': np.float64,
                                   'latitude': np.float64})
 
-# Add empty column to save the node id
-bus_stops_df['node_id'] = np.nan
-
-for idx, row in bus_stops_df.iterrows():
-    # Get the lon, lat of each row and find the closest graph node
-    stop_lon = row['longitude']
-    stop_lat = row['latitude']
-    # We are talking only about Manhattan, taking the euclidean with the
-    # coordinates doesn't affect the result
-    closest_node = min(pos.items(),
-                  key=lambda node: distance.euclidean((node[1][0], node[1][1]),
-                                                      (stop_lon, stop_lat)))
-    # Reposition the bus stop and add the node id
-    bus_stops_df.loc[idx, 'longitude'] = closest_node[1][0]
-    bus_stops_df.loc[idx, 'latitude'] = closest_node[1][1]
-    bus_stops_df.loc[idx, 'node_id'] = closest_node[0]
+# Find the closest graph node of all the bus stops at once.
+# We are talking only about Manhattan, taking the euclidean with the
+# coordinates doesn't affect the result
+if SNAP_TO_EDGES:
+    nearest_positions = graph.segment_index().nearest_ends
+else:
+    nearest_positions = graph.nearest_positions
+closest_nodes = nearest_positions(bus_stops_df['longitude'].values,
+                                  bus_stops_df['latitude'].values)
+# Reposition the bus stops and add the node id
+bus_stops_df['longitude'] = graph.lon[closest_nodes]
+bus_stops_df['latitude'] = graph.lat[closest_nodes]
+bus_stops_df['node_id'] = graph.node_ids[closest_nodes]
 
 # Save the repositioned bus stops to file
 bus_stops_df.to_csv(bus_stops_relocated_output, index=False)
@@ -1,10 +1,19 @@
 import csv
+import io
 import os
 import glob
+import shutil
+import tempfile
+from multiprocessing import Pool
 import xml.etree.ElementTree as ET
 from datetime import datetime
 from pathlib import Path
 
+import numpy as np
+import pandas as pd
+
+import TripStore
+
 # Boolean to define if we want to parse a maximum number of trips
 MAX_TRIPS_FILTER = False
 MAX_TRIPS = 10
@@ -12,6 +21,28 @@ MAX_TRIPS = 10
 DATE_FILTER = True
 MIN_DATE = datetime.strptime('01-11-2013', '%d-%m-%Y')
 MAX_DATE = datetime.strptime('07-11-2013', '%d-%m-%Y')
+# Boolean to define if we want to read the trips in chunks and filter each
+# chunk with vectorized masks instead of row by row. Only CHUNK_SIZE rows
+# are held in memory at any time.
+CHUNKED_INGESTION = True
+CHUNK_SIZE = 1000000
+# Boolean to define if we want to filter the trip files in parallel. Each
+# file is split in parts of about PART_SIZE bytes which are filtered by a
+# pool of N_PROCESSES processes (None for one per core) and then merged
+# in order, so the output is the same as the sequential one.
+PARALLEL_INGESTION = False
+N_PROCESSES = None
+PART_SIZE = 256 * 1024 * 1024
+# Boolean to define if we want to seek directly to the rows of
+# [MIN_DATE, MAX_DATE] instead of reading each file from the start. The
+# byte offset of every pickup hour is kept in a <trip file>.idx csv
+# built on the first run. Used by the chunked and parallel ingestion.
+DATE_INDEX = True
+# Format of the output, 'csv' or 'parquet' for the typed store partitioned
+# by pickup date and hour (see TripStore.py). With 'parquet' the csv is
+# only kept if EXPORT_CSV is True.
+OUTPUT_FORMAT = 'csv'
+EXPORT_CSV = False
 
 # Path to the folder which contains the FOIL trips .csv
 trips_data_folder = Path('D:/FOIL2013')
@@ -30,10 +61,11 @@ local_data_folder = Path('../data/')
 # The borders are the lon and lat min/max in which we are working
 OSM_file = local_data_folder / 'map.osm'
 
-# Parse the XML tree
-tree = ET.parse(OSM_file)
-root = tree.getroot()
-bounds = root.find('bounds').attrib
+# Parse the XML only until the bounds, they are at the start of the file
+for event, elem in ET.iterparse(OSM_file):
+    if elem.tag == 'bounds':
+        bounds = dict(elem.attrib)
+        break
 
 # Convert each coordinate str value in bounds to float
 for k, v in bounds.items():
@@ -49,69 +81,331 @@ if MAX_TRIPS_FILTER:
 output_filename += 'csv'
 output_file = local_data_folder / output_filename
 
-with open(output_file, 'w', newline='') as outputCSV:
-    # Set the headers for our output
-    fieldnames = ['pickup_datetime', 'dropoff_datetime',
-                  'pickup_longitude', 'pickup_latitude',
-                  'dropoff_longitude', 'dropoff_latitude']
-    writer = csv.DictWriter(outputCSV, fieldnames=fieldnames)
-    writer.writeheader()
-    # Counter in case we have MAX_TRIPS_FILTER to True
+# The headers for our output
+fieldnames = ['pickup_datetime', 'dropoff_datetime',
+              'pickup_longitude', 'pickup_latitude',
+              'dropoff_longitude', 'dropoff_latitude']
+
+
+def filter_chunk(chunk):
+    """Apply the date, boundaries and same location filters to a chunk of
+    trips read as strings. Returns the rows to keep and whether a trip after
+    MAX_DATE was found, in which case the rest of the file can be skipped.
+    """
+    pick_lon = pd.to_numeric(chunk['pickup_longitude'], errors='coerce').values
+    pick_lat = pd.to_numeric(chunk['pickup_latitude'], errors='coerce').values
+    drop_lon = pd.to_numeric(chunk['dropoff_longitude'], errors='coerce').values
+    drop_lat = pd.to_numeric(chunk['dropoff_latitude'], errors='coerce').values
+    # NaN (invalid locations) fail every comparison below
+    mask = (bounds['minlon'] <= pick_lon) & (pick_lon <= bounds['maxlon']) & \
+        (bounds['minlat'] <= pick_lat) & (pick_lat <= bounds['maxlat']) & \
+        (bounds['minlon'] <= drop_lon) & (drop_lon <= bounds['maxlon']) & \
+        (bounds['minlat'] <= drop_lat) & (drop_lat <= bounds['maxlat']) & \
+        ((pick_lon != drop_lon) | (pick_lat != drop_lat))
+    past_max_date = False
+    if DATE_FILTER:
+        # Compare only the dates, invalid dates become NaT and fail
+        pick_date = pd.to_datetime(chunk['pickup_datetime'].str[:10],
+                                   format='%Y-%m-%d', errors='coerce')
+        drop_date = pd.to_datetime(chunk['dropoff_datetime'].str[:10],
+                                   format='%Y-%m-%d', errors='coerce')
+        mask &= ((pick_date >= MIN_DATE) & (pick_date <= MAX_DATE) &
+                 (drop_date >= MIN_DATE) & (drop_date <= MAX_DATE)).values
+        # The trips are ordered by pick_date so drop everything from the
+        # first trip after the max
+        after_max = (pick_date > MAX_DATE).values
+        if after_max.any():
+            mask[np.argmax(after_max):] = False
+            past_max_date = True
+    return chunk[mask], past_max_date
+
+
+class FilePart(io.RawIOBase):
+    """Read only the bytes [start, end) of a file."""
+
+    def __init__(self, path, start, end):
+        super().__init__()
+        self.file = open(path, 'rb')
+        self.file.seek(start)
+        self.remaining = end - start
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        n = self.file.readinto(memoryview(b)[:min(len(b), self.remaining)])
+        self.remaining -= n
+        return n
+
+    def close(self):
+        self.file.close()
+        super().close()
+
+
+def build_date_index(input_file, index_file):
+    """Write the byte offset of the row where the pickup hour of input_file
+    first goes past each hour to index_file, so that every row before it
+    has an earlier pickup. The last row holds the file size so that a stale
+    index can be detected.
+
+    The rows of a day then start at the first hour of that day, and end at
+    the first hour of a later day if the file is ordered by pickup date,
+    which the date filter already expects. The hours within a day may be in
+    any order. A file not ordered by pickup date only gets the last row, so
+    that it is read in full without being scanned again.
+    """
+    print('Indexing file ' + input_file)
+    hours = []
+    offsets = []
+    ordered = True
+    with open(input_file, 'rb') as f:
+        header_line = f.readline()
+        header = [name.strip() for name in header_line.decode().split(',')]
+        pickup_col = header.index('pickup_datetime')
+        offset = len(header_line)
+        max_hour = b''
+        for line in f:
+            # 'YYYY-MM-DD HH' of the pickup, skip the malformed ones
+            hour = line.split(b',', pickup_col + 1)[pickup_col].strip()[:13]
+            if len(hour) == 13 and hour[:4].isdigit():
+                if hour > max_hour:
+                    hours.append(hour.decode())
+                    offsets.append(offset)
+                    max_hour = hour
+                elif hour[:10] < max_hour[:10]:
+                    ordered = False
+            offset += len(line)
+    if not ordered:
+        print('File is not ordered by pickup date, not indexed')
+        hours = []
+        offsets = []
+    hours.append('end')
+    offsets.append(offset)
+    pd.DataFrame({'pickup_hour': hours, 'offset': offsets}).to_csv(
+        index_file, index=False)
+
+
+def data_range(input_file):
+    """Return the header of input_file and the (start, end) byte offsets of
+    the rows to read. With DATE_INDEX the range covers only the pickup
+    dates in [MIN_DATE, MAX_DATE], otherwise all the rows.
+    """
+    size = os.path.getsize(input_file)
+    with open(input_file, 'rb') as f:
+        header_line = f.readline().decode()
+        start = f.tell()
+    header = [name.strip() for name in next(csv.reader([header_line]))]
+    end = size
+    if DATE_INDEX and DATE_FILTER:
+        index_file = input_file + '.idx'
+        index_df = None
+        if os.path.isfile(index_file):
+            index_df = pd.read_csv(index_file)
+            # Rebuild the index if the file has changed
+            if index_df['offset'].iloc[-1] != size:
+                index_df = None
+        if index_df is None:
+            build_date_index(input_file, index_file)
+            index_df = pd.read_csv(index_file)
+        # A file which is not ordered by date has no hours
+        if len(index_df) > 1:
+            hours = index_df['pickup_hour'].values[:-1]
+            offsets = index_df['offset'].values
+            dates = [hour[:10] for hour in hours]
+            # Hours are sorted so the first hour of MIN_DATE is the start and
+            # the first hour after MAX_DATE is the end
+            start = max(start, offsets[np.searchsorted(
+                dates, MIN_DATE.strftime('%Y-%m-%d'), side='left')])
+            end = offsets[np.searchsorted(
+                dates, MAX_DATE.strftime('%Y-%m-%d'), side='right')]
+    return header, start, end
+
+
+def parse_file_chunked(input_file, writer, trips_counter):
+    """Filter input_file in chunks of CHUNK_SIZE rows and write the kept
+    trips with writer. Returns the updated trips_counter.
+    """
+    header, start, end = data_range(input_file)
+    if start == end:
+        return trips_counter
+    # Read everything as str so that the values are written unchanged
+    with io.BufferedReader(FilePart(input_file, start, end)) as rows:
+        reader = pd.read_csv(rows, header=None, names=header,
+                             usecols=fieldnames, dtype=str,
+                             skipinitialspace=True, na_filter=False,
+                             chunksize=CHUNK_SIZE)
+        for chunk in reader:
+            trips, past_max_date = filter_chunk(chunk)
+            if MAX_TRIPS_FILTER:
+                trips = trips.iloc[:MAX_TRIPS - trips_counter]
+            writer.writerows(trips[fieldnames].values.tolist())
+            trips_counter += len(trips)
+            if past_max_date or \
+                    (MAX_TRIPS_FILTER and trips_counter == MAX_TRIPS):
+                break
+    return trips_counter
+
+
+def split_file(input_file, part_size):
+    """Split the rows of input_file to read in parts of about part_size
+    bytes which start at the beginning of a line. Returns the header and
+    the (start, end) offsets.
+    """
+    header, start, end = data_range(input_file)
+    if start == end:
+        return header, []
+    offsets = [start]
+    with open(input_file, 'rb') as f:
+        for split_point in range(start + part_size, end, part_size):
+            # Move to the start of the next line
+            f.seek(split_point - 1)
+            f.readline()
+            if offsets[-1] < f.tell() < end:
+                offsets.append(f.tell())
+    offsets.append(end)
+    return header, list(zip(offsets[:-1], offsets[1:]))
+
+
+def filter_part(input_file, header, start, end, part_output_file):
+    """Filter the bytes [start, end) of input_file and write the kept trips
+    to part_output_file. Returns the number of trips kept and whether a trip
+    after MAX_DATE was found.
+    """
     trips_counter = 0
+    past_max_date = False
+    with io.BufferedReader(FilePart(input_file, start, end)) as part, \
+            open(part_output_file, 'w', newline='') as outputCSV:
+        writer = csv.writer(outputCSV)
+        reader = pd.read_csv(part, header=None, names=header,
+                             usecols=fieldnames, dtype=str,
+                             skipinitialspace=True, na_filter=False,
+                             chunksize=CHUNK_SIZE)
+        for chunk in reader:
+            trips, past_max_date = filter_chunk(chunk)
+            writer.writerows(trips[fieldnames].values.tolist())
+            trips_counter += len(trips)
+            if past_max_date:
+                break
+    return trips_counter, past_max_date
+
+
+def parse_files_parallel(input_files):
+    """Filter the parts of all input_files in a process pool and merge the
+    outputs in file and offset order.
+    """
+    tmp_folder = tempfile.mkdtemp(dir=str(local_data_folder))
+    tasks = []
+    for file_idx, input_file in enumerate(input_files):
+        header, parts = split_file(input_file, PART_SIZE)
+        for start, end in parts:
+            part_output_file = os.path.join(tmp_folder,
+                                            'part.%05d.csv' % len(tasks))
+            tasks.append((input_file, header, start, end, part_output_file))
+    print('Filtering ' + str(len(input_files)) + ' files in ' +
+          str(len(tasks)) + ' parts')
+    with Pool(N_PROCESSES) as pool:
+        results = pool.starmap(filter_part, tasks)
+
+    with open(output_file, 'w', newline='') as outputCSV:
+        csv.DictWriter(outputCSV, fieldnames=fieldnames).writeheader()
+        trips_counter = 0
+        file_done = None
+        for task, (n_trips, past_max_date) in zip(tasks, results):
+            input_file, part_output_file = task[0], task[-1]
+            # Like the sequential parsing, skip the rest of a file after
+            # the first trip past MAX_DATE and stop at MAX_TRIPS
+            if input_file == file_done:
+                continue
+            if MAX_TRIPS_FILTER:
+                n_trips = min(n_trips, MAX_TRIPS - trips_counter)
+            with open(part_output_file, newline='') as partCSV:
+                if MAX_TRIPS_FILTER:
+                    outputCSV.writelines(partCSV.readline()
+                                         for _ in range(n_trips))
+                else:
+                    shutil.copyfileobj(partCSV, outputCSV)
+            trips_counter += n_trips
+            if past_max_date:
+                file_done = input_file
+            if MAX_TRIPS_FILTER and trips_counter == MAX_TRIPS:
+                break
+    shutil.rmtree(tmp_folder)
+
+
+# The pool re-imports this module in its processes, so the parsing only
+# runs from the main one
+if __name__ == '__main__' and PARALLEL_INGESTION:
+    parse_files_parallel(sorted(glob.glob(trips_pathname)))
+elif __name__ == '__main__':
+    with open(output_file, 'w', newline='') as outputCSV:
+        writer = csv.DictWriter(outputCSV, fieldnames=fieldnames)
+        writer.writeheader()
+        # Counter in case we have MAX_TRIPS_FILTER to True
+        trips_counter = 0
+
+        # For each file in our path
+        for inputFile in sorted(glob.glob(trips_pathname)):
+            # Exit if we have read the MAX_TRIPS
+            if MAX_TRIPS_FILTER and trips_counter == MAX_TRIPS:
+                break
+            print('Reading file ' + inputFile)
+            if CHUNKED_INGESTION:
+                trips_counter = parse_file_chunked(inputFile, csv.writer(outputCSV),
+                                                   trips_counter)
+                continue
+            with open(inputFile, newline='') as inputCSV:
+                reader = csv.DictReader(inputCSV, skipinitialspace=True)
+                for row in reader:
+                    # Stop reading if we have read the MAX_TRIPS
+                    if MAX_TRIPS_FILTER and trips_counter == MAX_TRIPS:
+                        break
+                    try:
+                        pick_lon = float(row['pickup_longitude'])
+                        pick_lat = float(row['pickup_latitude'])
+                        drop_lon = float(row['dropoff_longitude'])
+                        drop_lat = float(row['dropoff_latitude'])
+                        # Check the dates if we have enabled the filter
+                        if DATE_FILTER:
+                            # Get the pickup and dropoff dates
+                            pick_date_str = row['pickup_datetime'].split(' ')[0]
+                            pick_date = datetime.strptime(pick_date_str,
+                                                          '%Y-%m-%d')
+                            drop_date_str = row['dropoff_datetime'].split(' ')[0]
+                            drop_date = datetime.strptime(drop_date_str,
+                                                          '%Y-%m-%d')
+                            # The trips are ordered by pick_date so if we have
+                            # surpassed the max then stop
+                            if pick_date > MAX_DATE:
+                                break
+                            # If we are outside our window then continue
+                            if pick_date < MIN_DATE or pick_date > MAX_DATE \
+                                    or drop_date < MIN_DATE or drop_date > MAX_DATE:
+                                continue
+                        # Check if we are inside the boundaries of our map but
+                        # also check if the pick location is different than the
+                        # drop location since some of the input is wrong(same loc)
+                        if bounds['minlon'] <= pick_lon <= bounds['maxlon'] and \
+                            bounds['minlat'] <= pick_lat <= bounds['maxlat'] and \
+                            bounds['minlon'] <= drop_lon <= bounds['maxlon'] and \
+                            bounds['minlat'] <= drop_lat <= bounds['maxlat'] and \
+                                (pick_lon != drop_lon or pick_lat != drop_lat):
+
+                            # If all of the above are true then print the trip
+                            writer.writerow({
+                                'pickup_datetime': row['pickup_datetime'],
+                                'dropoff_datetime': row['dropoff_datetime'],
+                                'pickup_longitude': row['pickup_longitude'],
+                                'pickup_latitude': row['pickup_latitude'],
+                                'dropoff_longitude': row['dropoff_longitude'],
+                                'dropoff_latitude': row['dropoff_latitude']
+                            })
+                            trips_counter += 1
+                    except ValueError as e:
+                        print('Line with invalid location or time detected.')
+                        print(e)
 
-    # For each file in our path
-    for inputFile in glob.glob(trips_pathname):
-        # Exit if we have read the MAX_TRIPS
-        if MAX_TRIPS_FILTER and trips_counter == MAX_TRIPS:
-            break
-        print('Reading file ' + inputFile)
-        with open(inputFile, newline='') as inputCSV:
-            reader = csv.DictReader(inputCSV, skipinitialspace=True)
-            for row in reader:
-                # Stop reading if we have read the MAX_TRIPS
-                if MAX_TRIPS_FILTER and trips_counter == MAX_TRIPS:
-                    break
-                try:
-                    pick_lon = float(row['pickup_longitude'])
-                    pick_lat = float(row['pickup_latitude'])
-                    drop_lon = float(row['dropoff_longitude'])
-                    drop_lat = float(row['dropoff_latitude'])
-                    # Check the dates if we have enabled the filter
-                    if DATE_FILTER:
-                        # Get the pickup and dropoff dates
-                        pick_date_str = row['pickup_datetime'].split(' ')[0]
-                        pick_date = datetime.strptime(pick_date_str,
-                                                      '%Y-%m-%d')
-                        drop_date_str = row['dropoff_datetime'].split(' ')[0]
-                        drop_date = datetime.strptime(drop_date_str,
-                                                      '%Y-%m-%d')
-                        # The trips are ordered by pick_date so if we have
-                        # surpassed the max then stop
-                        if pick_date > MAX_DATE:
-                            break
-                        # If we are outside our window then continue
-                        if pick_date < MIN_DATE or pick_date > MAX_DATE \
-                                or drop_date < MIN_DATE or drop_date > MAX_DATE:
-                            continue
-                    # Check if we are inside the boundaries of our map but
-                    # also check if the pick location is different than the
-                    # drop location since some of the input is wrong(same loc)
-                    if bounds['minlon'] <= pick_lon <= bounds['maxlon'] and \
-                        bounds['minlat'] <= pick_lat <= bounds['maxlat'] and \
-                        bounds['minlon'] <= drop_lon <= bounds['maxlon'] and \
-                        bounds['minlat'] <= drop_lat <= bounds['maxlat'] and \
-                            (pick_lon != drop_lon or pick_lat != drop_lat):
-
-                        # If all of the above are true then print the trip
-                        writer.writerow({
-                            'pickup_datetime': row['pickup_datetime'],
-                            'dropoff_datetime': row['dropoff_datetime'],
-                            'pickup_longitude': row['pickup_longitude'],
-                            'pickup_latitude': row['pickup_latitude'],
-                            'dropoff_longitude': row['dropoff_longitude'],
-                            'dropoff_latitude': row['dropoff_latitude']
-                        })
-                        trips_counter += 1
-                except ValueError as e:
-                    print('Line with invalid location or time detected.')
-                    print(e)
+if __name__ == '__main__' and OUTPUT_FORMAT == 'parquet':
+    TripStore.convert_trips(output_file, output_file.with_suffix('.parquet'),
+                            chunksize=CHUNK_SIZE)
+    if not EXPORT_CSV:
+        os.remove(output_file)
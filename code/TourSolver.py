@@ -0,0 +1,148 @@
+"""
+Order the stops of a bus route as a closed tour (travelling salesman)
+
+The tours are found from a numpy matrix of the shortest path lengths between
+the stops, e.g. the one returned by OSMParser.RoadGraph.distance_matrix. The
+repetitive nearest neighbour gives the initial tour which is then improved
+with 2-opt and Or-opt moves. The matrix must be symmetric, which is the case
+for the undirected road graph.
+
+A tour is an array of stop indices (rows of the matrix) that starts and ends
+at the same stop.
+"""
+import time
+
+import numpy as np
+
+# Smallest improvement (m) for a move to be applied
+MIN_GAIN = 1e-7
+
+
+def tour_cost(dist, tour):
+    """ Return the total length of the tour."""
+    return dist[tour[:-1], tour[1:]].sum()
+
+
+def nearest_neighbour(dist):
+    """Run the nearest neighbour from every stop at once and return the
+    shortest tour.
+
+    Every step moves all the k tours to their closest unvisited stop, ties
+    go to the stop with the lowest index. Of the tours with the same length
+    the one starting from the lowest index is returned.
+    """
+    k = len(dist)
+    starts = np.arange(k)
+    tours = np.empty((k, k + 1), dtype=np.int64)
+    tours[:, 0] = starts
+    visited = np.zeros((k, k), dtype=bool)
+    visited[starts, starts] = True
+    current = starts
+    costs = np.zeros(k)
+    for step in range(1, k):
+        candidates = np.where(visited, np.inf, dist[current])
+        next_stops = np.argmin(candidates, axis=1)
+        costs += dist[current, next_stops]
+        current = next_stops
+        visited[starts, current] = True
+        tours[:, step] = current
+    # Close the circuits
+    tours[:, k] = starts
+    costs += dist[current, starts]
+    return tours[np.argmin(costs)]
+
+
+def two_opt_move(dist, tour):
+    """Apply the best 2-opt move to the closed tour, which reverses the part
+    of the tour between two of its edges. Returns the new tour, or None if
+    no move shortens it.
+    """
+    k = len(tour) - 1
+    a = tour[:-1]
+    b = tour[1:]
+    # Gain of replacing the edges (a[i], b[i]) and (a[j], b[j]) by
+    # (a[i], a[j]) and (b[i], b[j]), for every i < j
+    edge = dist[a, b]
+    delta = dist[a[:, None], a[None, :]] + dist[b[:, None], b[None, :]] - \
+        edge[:, None] - edge[None, :]
+    # Adjacent edges share a stop and give the same tour
+    i, j = np.indices((k, k))
+    delta[(j < i + 2) | ((i == 0) & (j == k - 1))] = np.inf
+    i, j = np.unravel_index(np.argmin(delta), delta.shape)
+    if delta[i, j] > -MIN_GAIN:
+        return None
+    tour = tour.copy()
+    tour[i + 1:j + 1] = tour[i + 1:j + 1][::-1]
+    return tour
+
+
+def or_opt_move(dist, tour, max_segment=3):
+    """Apply the best Or-opt move to the closed tour, which moves up to
+    max_segment consecutive stops between two other stops. Returns the new
+    tour, or None if no move shortens it.
+    """
+    k = len(tour) - 1
+    stops = tour[:-1]
+    best = (-MIN_GAIN, None)
+    for length in range(1, min(max_segment, k - 3) + 1):
+        # Segments stops[i:i + length] of the tour, for every i
+        first = stops
+        last = np.roll(stops, -(length - 1))
+        prev = np.roll(stops, 1)
+        after = np.roll(stops, -length)
+        removal_gain = dist[prev, first] + dist[last, after] - dist[prev, after]
+        # Cost of inserting each segment in every edge (x[p], y[p])
+        x = stops
+        y = np.roll(stops, -1)
+        delta = dist[x[None, :], first[:, None]] + \
+            dist[last[:, None], y[None, :]] - dist[x, y][None, :] - \
+            removal_gain[:, None]
+        # The edges around and inside the segment are not insertion points
+        i, p = np.indices((k, k))
+        delta[(p - i + 1) % k <= length] = np.inf
+        i, p = np.unravel_index(np.argmin(delta), delta.shape)
+        if delta[i, p] < best[0]:
+            best = (delta[i, p], (i, p, length))
+    if best[1] is None:
+        return None
+    i, p, length = best[1]
+    segment = np.arange(i, i + length) % k
+    rest = np.delete(stops, segment)
+    insert_at = np.flatnonzero(rest == stops[p])[0] + 1
+    stops = np.insert(rest, insert_at, stops[segment])
+    return np.append(stops, stops[0])
+
+
+def solve(dist, max_iterations=None, time_limit=None):
+    """Find a short closed tour through all the stops of dist.
+
+    Parameters
+    ----------
+    dist : (k, k) symmetric array of the lengths between the stops
+    max_iterations : maximum number of 2-opt/Or-opt moves, default no limit
+    time_limit : seconds after which no more moves are tried, default no
+        limit. 0 returns the nearest neighbour tour.
+
+    Returns the tour and its length. The tour starts and ends at the start
+    of the nearest neighbour tour.
+    """
+    start_time = time.perf_counter()
+    dist = np.asarray(dist, dtype=np.float64)
+    tour = nearest_neighbour(dist)
+    start = tour[0]
+    iteration = 0
+    while max_iterations is None or iteration < max_iterations:
+        if time_limit is not None and \
+                time.perf_counter() - start_time >= time_limit:
+            break
+        # 2-opt first, Or-opt only when 2-opt is stuck
+        new_tour = two_opt_move(dist, tour)
+        if new_tour is None:
+            new_tour = or_opt_move(dist, tour)
+        if new_tour is None:
+            break
+        tour = new_tour
+        iteration += 1
+    # Or-opt may move the first stop, rotate the tour back to it
+    stops = np.roll(tour[:-1], -np.flatnonzero(tour[:-1] == start)[0])
+    return np.append(stops, stops[0]), tour_cost(dist, tour)
@@ -0,0 +1,273 @@
+"""
+Round-based public transit router (RAPTOR) over the bus routes
+
+Instead of searching the road graph with the bus edges added to it, the
+trips are routed over the bus stops only. Every bus of bus_routes.csv gives
+two routes, its loop of stops in both directions, on which a bus leaves the
+first stop every headway seconds and then takes the durations of the bus
+edges between the stops (see BusNetwork.build_bus_edges). A loop is stored
+as two laps so that a ride may pass the first stop.
+
+Round k finds the earliest arrival at every stop with k buses: it scans the
+routes for the buses that can be caught from the arrivals of round k - 1 and
+then walks from the stops they reached to the other stops. The walks come
+from the walking durations between the stops and the nodes of the road
+graph, computed once with a Dijkstra from every stop and cached.
+
+Unlike the static bus edges the durations include the waiting at the stops,
+and the buses taken are counted from the rounds, so they are exact.
+"""
+import os
+
+import numpy as np
+from scipy.sparse import csgraph
+
+import BusNetwork
+import OSMParser
+
+# Seconds between two buses of a route
+HEADWAY = 600
+# Most buses taken by a trip, one more than the transfers
+MAX_BUSES = 4
+# Trips routed at once, the labels take a few (trips, stops) arrays per bus
+TRIPS_PER_CHUNK = 1000
+
+
+def routes_from_edges(edges):
+    """Return the routes of the bus edges of BusNetwork.build_bus_edges as a
+    list of (bus_id, stops, duration, length), stops being the node positions
+    of the route in order and duration and length the arrays of the legs
+    between them. Every bus gives its route in both directions.
+    """
+    u, v, length, duration, bus_id = (np.asarray(a) for a in edges)
+    buses, first = np.unique(bus_id, return_index=True)
+    last = np.r_[first[1:], len(bus_id)]
+    routes = []
+    for bus, a, b in zip(buses.tolist(), first, last):
+        stops = np.r_[u[a], v[a:b]]
+        for direction in (1, -1):
+            route_stops = stops[::direction]
+            route_duration = duration[a:b][::direction]
+            route_length = length[a:b][::direction]
+            if route_stops[0] == route_stops[-1]:
+                # Two laps of the loop
+                route_stops = np.r_[route_stops[:-1], route_stops]
+                route_duration = np.tile(route_duration, 2)
+                route_length = np.tile(route_length, 2)
+            routes.append((bus, route_stops, route_duration, route_length))
+    return routes
+
+
+def boarding_base(arrival, offset, headway):
+    """Return the departure time from the first stop of the earliest bus that
+    reaches the stop offset seconds after it at or after arrival.
+    """
+    if headway == 0:
+        return arrival - offset
+    return np.ceil((arrival - offset) / headway) * headway
+
+
+class TransitRouter:
+    """RAPTOR over the bus routes of the bus edges.
+
+    walk[i] holds the walking durations (s) from the stop i to every node of
+    the road graph, the stops being the nodes of the bus edges.
+
+    Parameters
+    ----------
+    headway : seconds between the buses of every route, or a dict of the
+        headway of every bus_id. 0 gives the durations of the static bus
+        edges, without waiting.
+    max_buses : most buses taken by a trip
+    max_transfer_walk : longest walk (s) between two buses, default no
+        limit
+    """
+    ARRAYS = ('stops', 'walk')
+
+    def __init__(self, graph, edges, headway=HEADWAY, max_buses=MAX_BUSES,
+                 max_transfer_walk=None, arrays=None):
+        self.graph = graph
+        self.max_buses = max_buses
+        # Walking over the whole road graph, the bus edges do not replace
+        # the streets
+        self.walking_csr = graph.to_csr(
+            np.asarray(graph.length) / BusNetwork.WALKING_SPEED)
+        if arrays is None:
+            stops = np.unique(np.concatenate(edges[:2]))
+            arrays = (stops, csgraph.dijkstra(self.walking_csr,
+                                              indices=stops))
+        self.stops, self.walk = arrays
+        self.footpaths = np.array(self.walk[:, self.stops])
+        if max_transfer_walk is not None:
+            self.footpaths[self.footpaths > max_transfer_walk] = np.inf
+        self.routes = []
+        for bus, stops, duration, length in routes_from_edges(edges):
+            self.routes.append((
+                bus, np.searchsorted(self.stops, stops),
+                np.r_[0, np.cumsum(duration)], np.r_[0, np.cumsum(length)],
+                headway.get(bus, HEADWAY) if isinstance(headway, dict)
+                else headway))
+
+    @classmethod
+    def cached(cls, graph, edges, cache_dir, mmap_mode='r', **options):
+        """Return the TransitRouter of the graph and bus edges, with the
+        walking durations computed once and saved in cache_dir under the
+        hash of the graph and the stops.
+        """
+        stops = np.unique(np.concatenate(edges[:2]))
+        key = BusNetwork.arrays_hash(graph.node_ids, graph.indptr,
+                                     graph.indices, graph.length, stops)
+        router_dir = os.path.join(str(cache_dir), key)
+        if os.path.isdir(router_dir):
+            return cls(graph, edges, arrays=BusNetwork.load_arrays(
+                router_dir, cls.ARRAYS, mmap_mode), **options)
+        router = cls(graph, edges, **options)
+        BusNetwork.cache_arrays(cache_dir, key, cls.ARRAYS,
+                                [getattr(router, name) for name in cls.ARRAYS])
+        return router
+
+    def _rounds(self, access, egress, departures):
+        """Run the rounds for the trips with the given walking durations to
+        and from every stop. Returns the arrival at the destination, the
+        round and the stop it is reached from, and the labels of every round.
+        """
+        n_trips, n_stops = access.shape
+        trips = np.arange(n_trips)
+        arrival = departures[:, None] + access
+        best = arrival.copy()
+        target = np.full(n_trips, np.inf)
+        target_round = np.zeros(n_trips, dtype=np.int64)
+        target_stop = np.zeros(n_trips, dtype=np.int64)
+        rounds = []
+        for k in range(1, self.max_buses + 1):
+            previous = arrival
+            arrival = previous.copy()
+            # 0 kept from round k - 1, 1 reached by a bus, 2 by a walk
+            kind = np.zeros((n_trips, n_stops), dtype=np.int8)
+            ride_arrival = np.full((n_trips, n_stops), np.inf)
+            ride_from = np.zeros((n_trips, n_stops), dtype=np.int64)
+            ride_bus = np.zeros((n_trips, n_stops), dtype=np.int64)
+            ride_length = np.zeros((n_trips, n_stops))
+            walk_from = np.zeros((n_trips, n_stops), dtype=np.int64)
+            for bus, stops, offset, cum_length, headway in self.routes:
+                base = np.full(n_trips, np.inf)
+                board = np.zeros(n_trips, dtype=np.int64)
+                for p, s in enumerate(stops):
+                    # Get off the current bus
+                    arrive = base + offset[p]
+                    better = arrive < np.minimum(best[:, s], target)
+                    if better.any():
+                        arrival[better, s] = arrive[better]
+                        best[better, s] = arrive[better]
+                        ride_arrival[better, s] = arrive[better]
+                        kind[better, s] = 1
+                        ride_from[better, s] = stops[board[better]]
+                        ride_bus[better, s] = bus
+                        ride_length[better, s] = \
+                            cum_length[p] - cum_length[board[better]]
+                    # Or catch an earlier bus
+                    earlier = boarding_base(previous[:, s], offset[p],
+                                            headway)
+                    earlier_bus = earlier < base
+                    base[earlier_bus] = earlier[earlier_bus]
+                    board[earlier_bus] = p
+            if not kind.any():
+                break
+            # Walk from the stops reached by a bus
+            for s in np.flatnonzero((kind == 1).any(axis=0)):
+                arrive = ride_arrival[:, s, None] + self.footpaths[s]
+                better = arrive < np.minimum(best, target[:, None])
+                arrival[better] = arrive[better]
+                best[better] = arrive[better]
+                kind[better] = 2
+                walk_from[better] = s
+            # Walk to the destination, with fewer buses on ties
+            at_target = arrival + egress
+            stop = np.argmin(at_target, axis=1)
+            better = at_target[trips, stop] < target
+            target[better] = at_target[trips, stop][better]
+            target_round[better] = k
+            target_stop[better] = stop[better]
+            rounds.append((kind, ride_from, ride_bus, ride_length, walk_from))
+        return target, target_round, target_stop, rounds
+
+    def _route_chunk(self, origins, destinations, departures):
+        access = self.walk[:, origins].T
+        egress = self.walk[:, destinations].T
+        target, k, s, rounds = self._rounds(access, egress, departures)
+        trips = np.arange(len(origins))
+        transit = k > 0
+        walking = np.where(transit, egress[trips, s], 0)
+        ride = np.zeros(len(origins))
+        legs = np.full((len(origins), self.max_buses), -1, dtype=np.int64)
+        # Follow the labels back from the destination
+        for r in range(len(rounds), 0, -1):
+            kind, ride_from, ride_bus, ride_length, walk_from = rounds[r - 1]
+            t = np.flatnonzero(k == r)
+            kept = kind[t, s[t]] == 0
+            k[t[kept]] -= 1
+            t = t[~kept]
+            walked = kind[t, s[t]] == 2
+            w = t[walked]
+            walking[w] += self.footpaths[walk_from[w, s[w]], s[w]]
+            s[w] = walk_from[w, s[w]]
+            legs[t, r - 1] = ride_bus[t, s[t]]
+            ride[t] += ride_length[t, s[t]]
+            s[t] = ride_from[t, s[t]]
+            k[t] -= 1
+        walking[transit] += access[trips, s][transit]
+        legs = np.sort(legs, axis=1)
+        buses = (legs >= 0).sum(axis=1)
+        unique_buses = ((legs[:, 1:] != legs[:, :-1]) &
+                        (legs[:, 1:] >= 0)).sum(axis=1) + \
+            (legs[:, 0] >= 0)
+        return (target - departures, buses, unique_buses, ride,
+                walking * BusNetwork.WALKING_SPEED)
+
+    def trip_statistics(self, origins, destinations, departures=None):
+        """Return the statistics of BusNetwork.path_statistics for the trips
+        between the node positions origins and destinations, as 5 arrays.
+
+        departures are the times (s) the trips leave, default 0. The buses of
+        every route leave its first stop at the multiples of the headway.
+        """
+        n_trips = len(origins)
+        if departures is None:
+            departures = np.zeros(n_trips)
+        departures = np.asarray(departures, dtype=np.float64)
+        stats = [np.empty(n_trips), np.empty(n_trips, dtype=np.int64),
+                 np.empty(n_trips, dtype=np.int64), np.empty(n_trips),
+                 np.empty(n_trips)]
+        for start in range(0, n_trips, TRIPS_PER_CHUNK):
+            chunk = slice(start, start + TRIPS_PER_CHUNK)
+            for stat, values in zip(stats, self._route_chunk(
+                    origins[chunk], destinations[chunk], departures[chunk])):
+                stat[chunk] = values
+        duration, buses, unique_buses, bus_ride_distance, \
+            walking_distance = stats
+
+        # Walk only when it is not longer, only searching when the straight
+        # line walk is shorter than the ride
+        lon, lat = self.graph.lon, self.graph.lat
+        lower_bound = OSMParser.haversine(
+            lon[origins], lat[origins], lon[destinations],
+            lat[destinations]) / BusNetwork.WALKING_SPEED
+        search = np.flatnonzero(lower_bound <= duration)
+        search = search[np.argsort(origins[search], kind='mergesort')]
+        group_starts = np.flatnonzero(np.diff(origins[search])) + 1
+        for trips in np.split(search, group_starts):
+            if not len(trips):
+                continue
+            o = origins[trips[0]]
+            walk = csgraph.dijkstra(self.walking_csr, indices=o,
+                                    limit=duration[trips].max())
+            walk = walk[destinations[trips]]
+            t = trips[walk <= duration[trips]]
+            walk = walk[walk <= duration[trips]]
+            duration[t] = walk
+            buses[t] = 0
+            unique_buses[t] = 0
+            bus_ride_distance[t] = 0
+            walking_distance[t] = walk * BusNetwork.WALKING_SPEED
+        return (duration, buses, unique_buses, bus_ride_distance,
+                walking_distance)
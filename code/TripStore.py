@@ -0,0 +1,198 @@
+"""
+Read and write the trips passed between the stages of the pipeline
+
+A trips file is either a .csv file or a .parquet store. The parquet store is
+a folder with typed columns (float32 coordinates, native timestamps) which
+is partitioned by pickup date and hour, so that readers only load the
+columns and partitions they need. The csv format is kept as an export.
+
+The parquet format needs pyarrow.
+"""
+from pathlib import Path
+import time
+
+import numpy as np
+import pandas as pd
+
+# Columns of the trips found by TaxiDataParser.py
+TRIP_COLUMNS = ['pickup_datetime', 'dropoff_datetime',
+                'pickup_longitude', 'pickup_latitude',
+                'dropoff_longitude', 'dropoff_latitude']
+DATETIME_COLUMNS = ['pickup_datetime', 'dropoff_datetime']
+FLOAT_COLUMNS = ['pickup_longitude', 'pickup_latitude',
+                 'dropoff_longitude', 'dropoff_latitude']
+# Partition columns of the parquet store, derived from pickup_datetime
+PARTITION_COLUMNS = ['pickup_date', 'pickup_hour']
+
+
+def trips_path(folder, name, trips_format):
+    """ Return the path of the trips file name.<trips_format> in folder."""
+    return Path(folder) / (name + '.' + trips_format)
+
+
+def is_parquet(path):
+    return Path(path).suffix == '.parquet'
+
+
+def typed_trips(trips_df):
+    """ Return trips_df with native timestamps and float32 coordinates."""
+    trips_df = trips_df.copy()
+    for column in DATETIME_COLUMNS:
+        if column in trips_df:
+            trips_df[column] = pd.to_datetime(trips_df[column])
+    for column in FLOAT_COLUMNS:
+        if column in trips_df:
+            trips_df[column] = trips_df[column].astype(np.float32)
+    return trips_df
+
+
+def write_trips(trips_df, path, append=False):
+    """Write trips_df to path, a .csv file or a .parquet store.
+
+    Tables with a pickup_datetime are partitioned by pickup date and hour,
+    other tables (e.g. the relocated trips) are written as a single
+    partition. With append the rows are added to the existing file/store.
+    """
+    if not is_parquet(path):
+        trips_df.to_csv(path, index=False, header=not append,
+                        mode='a' if append else 'w')
+        return
+
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    trips_df = typed_trips(trips_df)
+    partition_cols = None
+    if 'pickup_datetime' in trips_df:
+        trips_df['pickup_date'] = trips_df['pickup_datetime'].dt.strftime(
+            '%Y-%m-%d')
+        trips_df['pickup_hour'] = trips_df['pickup_datetime'].dt.hour
+        partition_cols = PARTITION_COLUMNS
+    if not append and Path(path).exists():
+        import shutil
+        shutil.rmtree(str(path))
+    table = pa.Table.from_pandas(trips_df, preserve_index=False)
+    # Every call adds new files to the partitions, named by the time of the
+    # call so that they sort in the order they were written
+    pq.write_to_dataset(table, str(path), partition_cols=partition_cols,
+                        basename_template='%020d-{i}.parquet' %
+                        time.time_ns())
+
+
+def read_trips(path, columns=None, dates=None, hours=None):
+    """Read the trips of path, a .csv file or a .parquet store.
+
+    Parameters
+    ----------
+    columns : list of the columns to read, default all
+    dates : list of pickup dates ('YYYY-MM-DD') to read, default all
+    hours : list of pickup hours (0-23) to read, default all
+
+    Only the parquet store skips the partitions of the other dates/hours,
+    the csv file is read in full and then filtered. The trips of the
+    parquet store are returned ordered by pickup_datetime, which is the
+    order of the trips found by TaxiDataParser.py.
+    """
+    if not is_parquet(path):
+        header = pd.read_csv(path, nrows=0).columns
+        usecols = list(header) if columns is None else list(columns)
+        filter_cols = ['pickup_datetime'] if dates or hours else []
+        trips_df = pd.read_csv(
+            path, usecols=list(dict.fromkeys(usecols + filter_cols)),
+            parse_dates=[c for c in DATETIME_COLUMNS
+                         if c in usecols + filter_cols],
+            dtype={c: np.float32 for c in FLOAT_COLUMNS if c in usecols})
+        if dates:
+            trips_df = trips_df[trips_df['pickup_datetime'].dt.strftime(
+                '%Y-%m-%d').isin(dates)]
+        if hours:
+            trips_df = trips_df[trips_df['pickup_datetime'].dt.hour.isin(
+                hours)]
+        return trips_df[usecols].reset_index(drop=True)
+
+    import pyarrow.parquet as pq
+
+    filters = []
+    if dates:
+        filters.append(('pickup_date', 'in', list(dates)))
+    if hours:
+        filters.append(('pickup_hour', 'in', list(hours)))
+    table = pq.read_table(str(path), columns=columns,
+                          filters=filters or None)
+    trips_df = table.to_pandas()
+    if columns is None:
+        trips_df = trips_df.drop(columns=[c for c in PARTITION_COLUMNS
+                                          if c in trips_df])
+    # The partitions are read in folder order, sort them back by time
+    # keeping the written order of equal times
+    if 'pickup_datetime' in trips_df:
+        trips_df = trips_df.sort_values('pickup_datetime', kind='mergesort')
+    return trips_df.reset_index(drop=True)
+
+
+def iter_trips(path, columns=None, chunksize=1000000):
+    """Yield the trips of path in DataFrames of chunksize rows (the last one
+    may be shorter), so that a file of any size can be processed in constant
+    memory. The partitions of a parquet store are read one at a time in
+    pickup time order, so that the trips come in the order of read_trips.
+    """
+    if not is_parquet(path):
+        header = pd.read_csv(path, nrows=0).columns
+        usecols = list(header) if columns is None else list(columns)
+        reader = pd.read_csv(
+            path, usecols=usecols, chunksize=chunksize,
+            parse_dates=[c for c in DATETIME_COLUMNS if c in usecols],
+            dtype={c: np.float32 for c in FLOAT_COLUMNS if c in usecols})
+        for chunk in reader:
+            yield chunk[usecols]
+        return
+
+    import pyarrow.dataset as ds
+
+    dataset = ds.dataset(str(path), format='parquet', partitioning='hive')
+    if columns is None:
+        columns = [c for c in dataset.schema.names
+                   if c not in PARTITION_COLUMNS]
+    columns = list(columns)
+    read_columns = columns
+    if 'pickup_datetime' in dataset.schema.names and \
+            'pickup_datetime' not in columns:
+        read_columns = columns + ['pickup_datetime']
+    # The partitions by date and hour, a store without pickup_datetime has
+    # a single one
+    partitions = {}
+    for fragment in dataset.get_fragments():
+        keys = ds.get_partition_keys(fragment.partition_expression)
+        partitions[(str(keys.get('pickup_date', '')),
+                    int(keys.get('pickup_hour', 0)))] = \
+            fragment.partition_expression
+    buffered = []
+    n_buffered = 0
+    for key in sorted(partitions):
+        trips_df = dataset.to_table(columns=read_columns,
+                                    filter=partitions[key]).to_pandas()
+        if 'pickup_datetime' in trips_df:
+            trips_df = trips_df.sort_values('pickup_datetime',
+                                            kind='mergesort')
+        buffered.append(trips_df[columns])
+        n_buffered += len(trips_df)
+        if n_buffered < chunksize:
+            continue
+        trips_df = pd.concat(buffered, ignore_index=True)
+        n_full = len(trips_df) // chunksize * chunksize
+        for start in range(0, n_full, chunksize):
+            yield trips_df.iloc[start:start + chunksize].reset_index(
+                drop=True)
+        buffered = [trips_df.iloc[n_full:]]
+        n_buffered = len(trips_df) - n_full
+    if n_buffered:
+        yield pd.concat(buffered, ignore_index=True)
+
+
+def convert_trips(input_path, output_path, chunksize=1000000):
+    """ Copy the trips of the csv file input_path to output_path in chunks."""
+    reader = pd.read_csv(input_path, chunksize=chunksize)
+    append = False
+    for chunk in reader:
+        write_trips(chunk, output_path, append=append)
+        append = True